@@ -0,0 +1,157 @@
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Hashable
+
+from app.loggerFyTops import logger
+from app.metrics import metrics, admissions_total, admission_wait_seconds
+
+class AdmissionRejected(Exception):
+    """A command was shed instead of admitted
+
+    ``reason`` is ``"user"`` (the user already has commands running), ``"queue"``
+    (the wait queue is full) or ``"deadline"`` (it could not start in time)
+    """
+
+    def __init__(self, reason: str):
+        self.reason = reason
+        super().__init__(f"command rejected: {reason}")
+
+class AdmissionController():
+    """Bound the number of commands running at once, globally and per user
+
+    Commands over the global limit wait in a bounded FIFO queue, but only as long
+    as they can still acknowledge their interaction before Discord's deadline: a
+    command that would start too late is rejected right away, so it can tell the
+    user to try again instead of timing out
+    """
+
+    def __init__(self, max_concurrent: int = 50, per_user: int = 2, max_queue: int = 200, margin: float = 0.5):
+        """
+        Create an admission controller
+
+        Attributes
+        ---
+        max_concurrent: :class:`int`
+            commands running at once
+        per_user: :class:`int`
+            commands a single user may have running or waiting
+        max_queue: :class:`int`
+            commands waiting for a slot
+        margin: :class:`float`
+            seconds kept before the deadline to acknowledge the interaction
+        """
+
+        self.max_concurrent = max_concurrent
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.margin = margin
+
+        self.running = 0
+        self._waiters = deque()
+        self._users = {} # user id -> commands running or waiting
+        self.hold = 1.0 # moving average of the seconds a slot is held
+
+    @asynccontextmanager
+    async def admit(self, user_id: Hashable, deadline: float):
+        """
+        Hold a slot for the duration of the ``with`` block, raising :class:`AdmissionRejected` when shed
+
+        Attributes
+        ---
+        user_id: :class:`Hashable`
+            Discord id of the user running the command
+        deadline: :class:`float`
+            :func:`time.monotonic` time by which the interaction must be acknowledged
+        """
+
+        await self.__acquire(user_id, deadline)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.__release(user_id, time.monotonic() - started)
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def __acquire(self, user_id: Hashable, deadline: float):
+        if self._users.get(user_id, 0) >= self.per_user:
+            self.__reject("user")
+
+        now = time.monotonic()
+        if self.running < self.max_concurrent and not self._waiters:
+            self.__admit(user_id, 0)
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            self.__reject("queue")
+
+        # Slots free up at max_concurrent / hold per second, shed what cannot start in time
+        budget = deadline - self.margin - now
+        expected = (len(self._waiters) + 1) * self.hold / self.max_concurrent
+        if expected > budget:
+            self.__reject("deadline")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self._users[user_id] = self._users.get(user_id, 0) + 1
+        try:
+            await asyncio.wait({future}, timeout=budget)
+        except asyncio.CancelledError:
+            # Do not take a slot handed over while being cancelled with us
+            if future.done() and not future.cancelled():
+                self.__hand_over()
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+                self._waiters.remove(future)
+            self.__forget(user_id)
+
+        # The slot was handed over by __release, already counted in running
+        if future.cancelled():
+            self.__reject("deadline")
+        self.__admit(user_id, time.monotonic() - now, handed_over=True)
+
+    def __admit(self, user_id: Hashable, waited: float, handed_over: bool = False):
+        if not handed_over:
+            self.running += 1
+        self._users[user_id] = self._users.get(user_id, 0) + 1
+        admissions_total.inc(outcome="admitted")
+        admission_wait_seconds.observe(waited)
+
+    def __release(self, user_id: Hashable, held: float):
+        self.hold = 0.9 * self.hold + 0.1 * held
+        self.__forget(user_id)
+        self.__hand_over()
+
+    def __hand_over(self):
+        """Give a freed slot to the first waiter still waiting"""
+
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    def __forget(self, user_id: Hashable):
+        count = self._users.get(user_id, 0) - 1
+        if count > 0:
+            self._users[user_id] = count
+        else:
+            self._users.pop(user_id, None)
+
+    def __reject(self, reason: str):
+        admissions_total.inc(outcome=f"rejected_{reason}")
+        logger.debug("Shedding a command (%s): %d running, %d queued", reason, self.running, len(self._waiters))
+        raise AdmissionRejected(reason)
+
+admission = AdmissionController()
+
+metrics.gauge("fytops_admission_running", "Commands currently holding an admission slot", lambda: admission.running)
+metrics.gauge("fytops_admission_queued", "Commands waiting for an admission slot", lambda: admission.queued)
+metrics.gauge("fytops_admission_hold_seconds", "Moving average of the seconds a command holds its slot", lambda: round(admission.hold, 3))
@@ -1,37 +1,150 @@
-from flask import Flask, request, jsonify
-import requests
-from flask_cors import CORS
-
-app = Flask(__name__)
-CORS(app, origins=['https://render-test-61we.onrender.com'])
-
-@app.route('/callback', methods=['POST'])
-def receive_code():
-    data = request.get_json()
-    auth_code = data.get('code')
-    
-    if not auth_code:
-        return jsonify({'error': 'No code provided'}), 400
-    
-    token_url = 'https://accounts.spotify.com/api/token'
-    payload = {
-        'grant_type': 'authorization_code',
-        'code': auth_code,
-        'redirect_uri': 'https://your-static-site.com/',
-        'client_id': 'your-client-id',
-        'client_secret': 'your-client-secret'
-    }
-
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-
-    response = requests.post(token_url, data=payload, headers=headers)
-
-    if response.status_code == 200:
-        return jsonify(response.json())
-    else:
-        return jsonify({'error': 'Token exchange failed', 'details': response.text}), 400
-    
-if __name__ == '__main__':
-    app.run (debug=True)
\ No newline at end of file
+import asyncio
+import aiohttp
+from aiohttp import web
+from typing import Callable, Optional
+
+from app.metrics import metrics
+from app.sharedcache import shared_cache
+from app.spotifyapp import SpotifyApp, SpotifyAppOAuth
+from app.spotifyclient import SpotifyException, SpotifyOauthError, is_transient
+from app.loggerFyTops import logger
+
+ALLOWED_ORIGINS = {'https://render-test-61we.onrender.com'}
+
+PAGE = """<!DOCTYPE html>
+<html lang="en">
+    <head><meta charset="UTF-8"><title>FyTops</title></head>
+    <body><h2>{message}</h2></body>
+</html>"""
+
+class CallbackServer():
+    """OAuth callback and metrics server running in the bot's event loop
+
+    Spotify redirects the user to ``/callback`` with an authorization code and the
+    signed, single-use ``state`` naming their Discord account, the code is exchanged
+    through the shared Spotify session and the token stored right away
+    """
+
+    def __init__(self, client_secret: str, create_auth_manager: Callable, on_login: Callable, host: str = "0.0.0.0", port: int = 5000):
+        """
+        Create the callback server
+
+        Attributes
+        ---
+        client_secret: :class:`str`
+            Spotify client secret verifying the ``state`` signature
+        create_auth_manager: :class:`Callable`
+            builds the :class:`SpotifyAppOAuth` of a Discord user id
+        on_login: :class:`Callable`
+            coroutine function called with the Discord user id once a token is stored
+        host: :class:`str`
+            interface to listen on
+        port: :class:`int`
+            port to listen on
+        """
+
+        self.client_secret = client_secret
+        self.create_auth_manager = create_auth_manager
+        self.on_login = on_login
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+        self.app = web.Application(middlewares=[self.cors])
+        self.app.router.add_get("/callback", self.receive_redirect)
+        self.app.router.add_post("/callback", self.receive_code)
+        self.app.router.add_get("/metrics", self.export_metrics)
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Callback server listening on %s:%s", self.host, self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @web.middleware
+    async def cors(self, request: web.Request, handler: Callable) -> web.StreamResponse:
+        """Let the static redirect page POST the code from another origin"""
+
+        origin = request.headers.get("Origin")
+        if request.method == "OPTIONS":
+            response = web.Response()
+        else:
+            response = await handler(request)
+
+        if origin in ALLOWED_ORIGINS:
+            response.headers["Access-Control-Allow-Origin"] = origin
+            response.headers["Access-Control-Allow-Headers"] = "Content-Type"
+            response.headers["Access-Control-Allow-Methods"] = "GET, POST"
+        return response
+
+    async def receive_redirect(self, request: web.Request) -> web.Response:
+        """Spotify redirected the user here directly"""
+
+        if "error" in request.query:
+            return self.page("Spotify authorization was cancelled, you can close this tab.", 400)
+
+        status, message = await self.link(request.query.get("code"), request.query.get("state"))
+        return self.page(message, status)
+
+    async def receive_code(self, request: web.Request) -> web.Response:
+        """The static redirect page forwarded the code"""
+
+        try:
+            data = await request.json()
+        except ValueError:
+            data = {}
+
+        status, message = await self.link(data.get("code"), data.get("state"))
+        return web.json_response({"message": message} if status == 200 else {"error": message}, status=status)
+
+    async def link(self, code: Optional[str], state: Optional[str]) -> tuple:
+        """Exchange an authorization code and store the token, returning an HTTP status and message"""
+
+        if not code:
+            return 400, "No authorization code provided."
+
+        verified = SpotifyAppOAuth.verify_state(state, self.client_secret)
+        if verified is None:
+            logger.warning("Rejected an OAuth callback with an invalid or expired state")
+            return 400, "This login link is invalid or expired, use /login in Discord to get a new one."
+        
+        # Consumed before the exchange, so a replayed or forwarded link is never completed twice
+        user_id, nonce = verified
+        if not await asyncio.to_thread(shared_cache.add, "oauth_state", nonce, user_id, ttl=SpotifyAppOAuth.STATE_TTL):
+            logger.warning("%s: Rejected an OAuth callback reusing a state", user_id)
+            return 400, "This login link was already used, use /login in Discord to get a new one."
+
+        # The linked account may have changed
+        await SpotifyApp.invalidate_user(user_id)
+        try:
+            await self.create_auth_manager(user_id).get_access_token_async(code=code)
+        except SpotifyOauthError as e:
+            logger.error("%s: Token exchange error: %s", user_id, e)
+            return 400, "Spotify rejected this authorization code, use /login in Discord to try again."
+        
+        # The link is spent, a new one is needed once Spotify answers again
+        except (SpotifyException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if not is_transient(e):
+                raise
+            logger.warning("%s: Spotify unavailable during the token exchange: %s", user_id, e)
+            return 503, "Spotify is not responding right now, wait a minute then use /login in Discord to get a new link."
+
+        logger.info("%s: Access token created from the OAuth callback", user_id)
+        await self.on_login(user_id)
+        return 200, "Authentication successful! You can close this tab and return to Discord."
+
+    async def export_metrics(self, request: web.Request) -> web.Response:
+        """Expose the bot's metrics in the Prometheus text format"""
+
+        response = web.Response(text=metrics.render())
+        response.headers["Content-Type"] = metrics.CONTENT_TYPE
+        return response
+
+    @staticmethod
+    def page(message: str, status: int = 200) -> web.Response:
+        return web.Response(text=PAGE.format(message=message), status=status, content_type="text/html")
@@ -0,0 +1,184 @@
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+from app.loggerFyTops import logger
+from app.metrics import cache_requests_total
+
+class TTLCache():
+    """In-memory cache whose entries expire after a fixed time-to-live
+
+    The cache is bounded to ``maxsize`` entries, the least recently used entry
+    is evicted first once it is full
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 600, name: str = None):
+        """
+        Create a bounded time-to-live cache
+
+        Attributes
+        ---
+        maxsize: :class:`int`
+            maximum number of entries kept in memory
+        ttl: :class:`float`
+            number of seconds an entry stays valid
+        name: :class:`str`
+            name reported in the cache hit rate metrics, lookups are not counted if omitted
+        """
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            del self._data[key]
+            entry = None
+
+        if self.name is not None:
+            cache_requests_total.inc(cache=self.name, result="miss" if entry is None else "hit")
+
+        if entry is None:
+            return default
+
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def items(self) -> list:
+        """Return the ``(key, value)`` pairs that have not expired"""
+
+        now = time.monotonic()
+        return [(key, entry[1]) for key, entry in self._data.items() if entry[0] > now]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, None) is not None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+class StaleWhileRevalidateCache():
+    """Response cache serving stale entries immediately while refreshing them in the background
+
+    Each entry belongs to a kind with its own ``(fresh, stale)`` lifetimes: within
+    ``fresh`` seconds an entry is returned as is, within ``fresh + stale`` seconds
+    it is returned and refreshed in the background, afterwards it is fetched again
+    """
+
+    def __init__(self, ttls: dict, maxsize: int = 4096, degrade_on: Callable[[Exception], bool] = None):
+        """
+        Create a stale-while-revalidate cache
+
+        Attributes
+        ---
+        ttls: :class:`dict`
+            maps a kind to its ``(fresh, stale)`` lifetimes in seconds
+        maxsize: :class:`int`
+            maximum number of entries kept in memory
+        degrade_on: :class:`Callable`
+            tells whether a fetch error may be answered with an expired entry, e.g.
+            while the upstream service is unavailable
+        """
+
+        self.ttls = ttls
+        self.maxsize = maxsize
+        self.degrade_on = degrade_on
+        self._data: OrderedDict = OrderedDict()
+        self._refreshing = {}
+        self._listeners = []
+
+    async def get(self, key: tuple, kind: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Return the cached value of ``key``, calling ``fetch`` when missing or expired
+
+        Attributes
+        ---
+        key: :class:`tuple`
+            cache key, its first element is the owner's Discord user id
+        kind: :class:`str`
+            entry kind selecting the lifetimes in ``ttls``
+        fetch: :class:`Callable`
+            coroutine function producing a fresh value
+        """
+
+        fresh, stale = self.ttls[kind]
+        entry = self._data.get(key)
+
+        if entry is not None:
+            fetched_at, value = entry
+            age = time.monotonic() - fetched_at
+            self._data.move_to_end(key)
+
+            if age < fresh:
+                cache_requests_total.inc(cache=kind, result="hit")
+                return value
+
+            if age < fresh + stale:
+                cache_requests_total.inc(cache=kind, result="stale")
+                if key not in self._refreshing:
+                    task = asyncio.create_task(self.__refresh(key, fetch))
+                    self._refreshing[key] = task
+                return value
+
+        cache_requests_total.inc(cache=kind, result="miss")
+        try:
+            value = await fetch()
+        except Exception as e:
+            # Expired entries stay in memory until evicted, better than no answer at all
+            if entry is None or self.degrade_on is None or not self.degrade_on(e):
+                raise
+            cache_requests_total.inc(cache=kind, result="degraded")
+            logger.warning("%s: Serving an expired %s entry, fetching it failed: %s", key[0], kind, e)
+            return entry[1]
+
+        self.set(key, value)
+        return value
+
+    def set(self, key: tuple, value: Any):
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+        for listener in self._listeners:
+            listener(key, value)
+
+    def subscribe(self, listener: Callable[[tuple, Any], None]):
+        """Call ``listener`` with the key and value of every entry stored, fetched or refreshed"""
+
+        self._listeners.append(listener)
+
+    def invalidate_user(self, user_id: int):
+        """Drop every entry owned by a Discord user"""
+
+        for key in [key for key in self._data if key[0] == user_id]:
+            del self._data[key]
+
+        for key in [key for key in self._refreshing if key[0] == user_id]:
+            self._refreshing.pop(key).cancel()
+
+    async def __refresh(self, key: tuple, fetch: Callable[[], Awaitable[Any]]):
+        try:
+            self.set(key, await fetch())
+        except Exception as e:
+            logger.warning("%s: Background refresh of %s failed: %s", key[0], key[1:], e)
+        finally:
+            self._refreshing.pop(key, None)
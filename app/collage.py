@@ -0,0 +1,307 @@
+import os
+import glob
+import time
+import asyncio
+import hashlib
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from app.loggerFyTops import logger
+from app.singleflight import SingleFlight
+from app.sharedcache import SharedCache, shared_cache
+from app.colorengine import color_engine, FALLBACK_COLOR
+from app.metrics import cache_requests_total
+
+def compose_collage(images: list, grid: int, tile: int, quality: int = 85) -> bytes:
+    """
+    Compose a ``grid`` x ``grid`` collage of square tiles
+
+    Each image is center-cropped and resized to ``tile`` x ``tile`` pixels, missing
+    or unreadable images leave a plain tile. Runs inside a worker process.
+
+    Returns
+    ---
+    :class:`bytes`
+        JPEG content of the collage
+    """
+
+    # Only needed in the worker processes, keeps them out of the bot's startup
+    from PIL import Image, ImageOps
+
+    card = Image.new("RGB", (grid * tile, grid * tile), FALLBACK_COLOR)
+    for index, content in enumerate(images[:grid * grid]):
+        if content is None:
+            continue
+        try:
+            with Image.open(BytesIO(content)) as image:
+                image.draft("RGB", (tile, tile)) # let JPEG decoding downscale for free
+                image = ImageOps.fit(image.convert("RGB"), (tile, tile), Image.LANCZOS)
+        except OSError:
+            continue
+        card.paste(image, ((index % grid) * tile, (index // grid) * tile))
+
+    output = BytesIO()
+    card.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+class ArtworkCache():
+    """Content-addressed disk cache of downloaded artwork
+
+    Files are named after the SHA-256 of their content, a URL is mapped to its
+    content hash through the shared cache so every worker process reuses them.
+    Each process indexes the files it has seen and removes its least recently
+    used ones above ``max_bytes``, files downloaded by other processes after the
+    first scan are not counted, so the directory can grow up to about
+    ``max_bytes`` per worker process.
+    """
+
+    def __init__(self, directory: str = "cache/artwork", max_bytes: int = 256 * 1024 * 1024, store: SharedCache = shared_cache):
+        """
+        Create an artwork cache
+
+        Attributes
+        ---
+        directory: :class:`str`
+            directory the artwork files are written to
+        max_bytes: :class:`int`
+            total size of the files a process keeps on disk
+        store: :class:`SharedCache`
+            shared cache mapping an artwork URL to its content hash
+        """
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.store = store
+        self._files: Optional[OrderedDict] = None # content hash -> size, least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+        self._inflight = SingleFlight()
+
+    async def get(self, url: str, fetch: Callable[[str], Awaitable[bytes]]) -> Optional[bytes]:
+        """Return the content of the artwork at ``url``, downloading it with ``fetch`` on a miss"""
+
+        digest = await asyncio.to_thread(self.store.get, "artwork_url", url)
+        if digest is not None:
+            content = await asyncio.to_thread(self.__read, digest)
+            if content is not None:
+                cache_requests_total.inc(cache="artwork", result="hit")
+                self.__touch(digest, len(content))
+                return content
+
+        cache_requests_total.inc(cache="artwork", result="miss")
+        try:
+            return await self._inflight.do(url, lambda: self.__download(url, fetch))
+        except Exception as e:
+            logger.warning("Unable to download artwork %s: %s", url, e)
+            return None
+
+    async def __download(self, url: str, fetch: Callable[[str], Awaitable[bytes]]) -> bytes:
+        content = await fetch(url)
+        digest = hashlib.sha256(content).hexdigest()
+
+        await asyncio.to_thread(self.__write, digest, content)
+        await asyncio.to_thread(self.store.set, "artwork_url", url, digest)
+        await asyncio.to_thread(self.__add, digest, len(content))
+        return content
+
+    def __path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def __read(self, digest: str) -> Optional[bytes]:
+        try:
+            with open(self.__path(digest), "rb") as f:
+                return f.read()
+        except OSError:
+            return None # evicted, possibly by another worker process
+
+    def __write(self, digest: str, content: bytes):
+        path = self.__path(digest)
+        if os.path.exists(path):
+            return # same content under another URL
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write then rename, readers in other processes never see a partial file
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(content)
+        os.replace(temporary, path)
+
+    def __files(self) -> OrderedDict:
+        """Index of the files on disk, scanned once, oldest first"""
+
+        if self._files is None:
+            entries = []
+            for path in glob.glob(os.path.join(self.directory, "*", "*")):
+                if path.endswith(".tmp"):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, os.path.basename(path), stat.st_size))
+
+            self._files = OrderedDict((digest, size) for _, digest, size in sorted(entries))
+            self._size = sum(self._files.values())
+        return self._files
+
+    def __touch(self, digest: str, size: int):
+        with self._lock:
+            # The index is built by the first download, scanning the directory off the event loop
+            if self._files is None:
+                return
+            if digest in self._files:
+                self._files.move_to_end(digest)
+            else:
+                self._files[digest] = size
+                self._size += size
+
+    def __add(self, digest: str, size: int):
+        """Index a new file, then evict the least recently used ones above ``max_bytes``"""
+
+        with self._lock:
+            files = self.__files()
+            if digest not in files:
+                files[digest] = size
+                self._size += size
+            files.move_to_end(digest)
+
+            while self._size > self.max_bytes and len(files) > 1:
+                oldest, oldest_size = files.popitem(last=False)
+                self._size -= oldest_size
+                try:
+                    os.remove(self.__path(oldest))
+                except OSError:
+                    pass
+
+class CardRenderer():
+    """Render collage cards of a user's top artists or tracks
+
+    Finished cards are kept on disk per user, kind, time range and grid size for
+    ``ttl`` seconds, so a repeated request is a single file read. Expired cards
+    are deleted periodically by a single process
+    """
+
+    def __init__(self, artwork: ArtworkCache, directory: str = "cache/cards", ttl: float = 3600, purge_interval: float = 3600):
+        """
+        Create a card renderer
+
+        Attributes
+        ---
+        artwork: :class:`ArtworkCache`
+            cache the tiles are downloaded into
+        directory: :class:`str`
+            directory the finished cards are written to
+        ttl: :class:`float`
+            number of seconds a finished card is reused
+        purge_interval: :class:`float`
+            number of seconds between two purges of the expired cards
+        """
+
+        self.artwork = artwork
+        self.directory = directory
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._inflight = SingleFlight()
+        self._task: Optional[asyncio.Task] = None
+
+    def __path(self, user_id: int, kind: str, time_range: str, grid: int) -> str:
+        return os.path.join(self.directory, f"{user_id}_{kind}_{time_range}_{grid}.jpg")
+
+    async def cached(self, user_id: int, kind: str, time_range: str, grid: int) -> Optional[bytes]:
+        """Return a finished card if it is recent enough"""
+
+        content = await asyncio.to_thread(self.__read_fresh, self.__path(user_id, kind, time_range, grid))
+        cache_requests_total.inc(cache="card", result="miss" if content is None else "hit")
+        return content
+
+    async def render(self, user_id: int, kind: str, time_range: str, grid: int, urls: list, fetch: Callable[[str], Awaitable[bytes]]) -> bytes:
+        """
+        Render a card from the artwork at ``urls`` and keep it on disk
+
+        Attributes
+        ---
+        urls: :class:`list`
+            artwork URLs of the tiles in order, ``None`` for an item without artwork
+        fetch: :class:`Callable`
+            coroutine function downloading an artwork missing from the cache
+        """
+
+        path = self.__path(user_id, kind, time_range, grid)
+        return await self._inflight.do(path, lambda: self.__render(path, grid, urls, fetch))
+
+    def invalidate_user(self, user_id: int):
+        """Drop the finished cards of a Discord user"""
+
+        for path in glob.glob(os.path.join(self.directory, f"{user_id}_*.jpg")):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def purge(self) -> int:
+        """Delete the expired cards and the leftovers of interrupted writes, returning how many were deleted"""
+
+        removed = 0
+        expired_at = time.time() - self.ttl
+        for path in glob.glob(os.path.join(self.directory, "*")):
+            try:
+                if os.stat(path).st_mtime <= expired_at:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass # rewritten or removed by another process meanwhile
+        return removed
+
+    def start(self):
+        """Periodically delete the expired cards, from a single process"""
+
+        if self._task is None:
+            self._task = asyncio.create_task(self.__purge_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def __purge_loop(self):
+        while True:
+            try:
+                removed = await asyncio.to_thread(self.purge)
+                logger.debug("Deleted %d expired cards", removed)
+            except Exception as e:
+                logger.warning("Unable to purge the cards: %s", e)
+            await asyncio.sleep(self.purge_interval)
+
+    async def __render(self, path: str, grid: int, urls: list, fetch: Callable[[str], Awaitable[bytes]]) -> bytes:
+        async def download(url: Optional[str]) -> Optional[bytes]:
+            return None if url is None else await self.artwork.get(url, fetch)
+
+        images = await asyncio.gather(*(download(url) for url in urls[:grid * grid]))
+
+        loop = asyncio.get_running_loop()
+        content = await loop.run_in_executor(color_engine.pool(), compose_collage, images, grid, 900 // grid)
+
+        await asyncio.to_thread(self.__write, path, content)
+        logger.debug("Rendered a %dx%d card into %s", grid, grid, path)
+        return content
+
+    def __read_fresh(self, path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_mtime + self.ttl <= time.time():
+                    return None
+                return f.read()
+        except OSError:
+            return None
+
+    def __write(self, path: str, content: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(content)
+        os.replace(temporary, path)
+
+# Tiles are composed in the color engine's process pool
+card_renderer = CardRenderer(ArtworkCache())
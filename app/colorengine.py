@@ -0,0 +1,180 @@
+import os
+import json
+import asyncio
+import sqlite3
+import hashlib
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Optional
+
+from app.loggerFyTops import logger
+from app.singleflight import SingleFlight
+from app.sharedcache import SharedCache, shared_cache
+from app.metrics import cache_requests_total
+
+# Default avatar shown for Spotify accounts without a profile picture
+NULL_IMAGE = "https://media.discordapp.net/attachments/1374160501877248113/1377302749628076062/null_avatar.png?ex=683878a4&is=68372724&hm=91a9d8e64bcdd49ae6a57b5684bd8ea47c84d910b5e961ba08a6c6eecd7b80f7&=&format=webp&quality=lossless&width=1260&height=1260"
+FALLBACK_COLOR = (153, 170, 181)
+
+def extract_dominant_color(content: bytes, size: int = 64, bits: int = 4) -> tuple:
+    """
+    Compute the dominant color of an image
+
+    The image is downscaled to at most ``size`` x ``size`` pixels, each pixel is
+    quantized to ``bits`` bits per channel and the most populated color bucket
+    is averaged back to full precision. Runs inside a worker process.
+
+    Returns
+    ---
+    :class:`tuple`
+        (r, g, b) dominant color
+    """
+
+    # Only needed in the worker processes, keeps them out of the bot's startup
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(BytesIO(content)) as image:
+        image.draft("RGB", (size, size)) # let JPEG decoding downscale for free
+        image = image.convert("RGBA")
+        image.thumbnail((size, size))
+        pixels = np.asarray(image).reshape(-1, 4)
+
+    # Ignore transparent and near-white pixels, same as ColorThief
+    mask = (pixels[:, 3] >= 125) & ~np.all(pixels[:, :3] > 250, axis=1)
+    rgb = pixels[mask, :3] if mask.any() else pixels[:, :3]
+
+    q = (rgb >> (8 - bits)).astype(np.int32)
+    buckets = (q[:, 0] << (2 * bits)) | (q[:, 1] << bits) | q[:, 2]
+    best = np.bincount(buckets, minlength=1 << (3 * bits)).argmax()
+
+    r, g, b = rgb[buckets == best].mean(axis=0).round().astype(int)
+    return int(r), int(g), int(b)
+
+class ColorEngine():
+    """Content-addressed dominant color service with a persistent cache shared by every worker"""
+
+    def __init__(self, store: SharedCache = shared_cache, legacy_path: str = "cache/colors.json", maxsize: int = 50000, max_workers: int = None):
+        """
+        Create a dominant color service
+
+        Attributes
+        ---
+        store: :class:`SharedCache`
+            persistent cache behind the in-memory one, shared by every worker process
+        legacy_path: :class:`str`
+            JSON color cache of earlier versions, imported into ``store`` by :meth:`migrate`
+        maxsize: :class:`int`
+            maximum number of URLs and content hashes remembered in memory
+        max_workers: :class:`int`
+            size of the color extraction process pool
+        """
+
+        self.store = store
+        self.legacy_path = legacy_path
+        self.maxsize = maxsize
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._by_url: OrderedDict = OrderedDict()
+        self._by_hash: OrderedDict = OrderedDict()
+        self._inflight = SingleFlight()
+
+    def migrate(self):
+        """One-shot import of the legacy JSON color cache
+
+        Run once before the workers start, a concurrent run is tolerated
+        """
+
+        legacy_path = self.legacy_path
+        try:
+            with open(legacy_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        self.store.set_many("color_url", data.get("urls", {}))
+        self.store.set_many("color_hash", data.get("hashes", {}))
+        try:
+            os.rename(legacy_path, f"{legacy_path}.migrated")
+        except FileNotFoundError:
+            return # migrated by another process meanwhile
+        logger.info("Migrated %d cached colors from %s into %s", len(data.get("urls", {})), legacy_path, self.store.path)
+
+    async def lookup(self, namespace: str, key: str) -> Optional[tuple]:
+        """Return a color from memory, or from the shared store if another worker computed it"""
+
+        mapping = self._by_url if namespace == "color_url" else self._by_hash
+        rgb = mapping.get(key)
+        if rgb is not None:
+            mapping.move_to_end(key)
+            return rgb
+
+        rgb = await asyncio.to_thread(self.store.get, namespace, key)
+        if rgb is not None:
+            rgb = tuple(rgb)
+            self.__remember(mapping, key, rgb)
+        return rgb
+
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def get_color(self, url: str, fetch: Callable[[str], Awaitable[bytes]]) -> tuple:
+        """
+        Return the dominant color of the image at ``url``
+
+        Attributes
+        ---
+        url: :class:`str`
+            image URL, looked up in the cache before anything is downloaded
+        fetch: :class:`Callable`
+            coroutine function downloading the image content on a cache miss
+        """
+
+        if url == NULL_IMAGE:
+            return FALLBACK_COLOR
+
+        rgb = await self.lookup("color_url", url)
+        if rgb is not None:
+            cache_requests_total.inc(cache="color", result="hit")
+            return rgb
+
+        cache_requests_total.inc(cache="color", result="miss")
+        return await self._inflight.do(url, lambda: self.__compute(url, fetch))
+
+    async def __compute(self, url: str, fetch: Callable[[str], Awaitable[bytes]]) -> tuple:
+        content = await fetch(url)
+        digest = hashlib.sha256(content).hexdigest()
+
+        rgb = await self.lookup("color_hash", digest)
+        if rgb is None:
+            loop = asyncio.get_running_loop()
+            rgb = await loop.run_in_executor(self.pool(), extract_dominant_color, content)
+            self.__remember(self._by_hash, digest, rgb)
+            await self.__persist("color_hash", digest, rgb)
+            logger.debug("Computed dominant color %s for image %.12s", rgb, digest)
+
+        self.__remember(self._by_url, url, rgb)
+        await self.__persist("color_url", url, rgb)
+        return rgb
+
+    async def __persist(self, namespace: str, key: str, rgb: tuple):
+        try:
+            await asyncio.to_thread(self.store.set, namespace, key, rgb)
+        except sqlite3.Error as e:
+            logger.error("Unable to persist color cache: %s", e)
+
+    def __remember(self, mapping: OrderedDict, key: str, rgb: tuple):
+        mapping[key] = rgb
+        mapping.move_to_end(key)
+        while len(mapping) > self.maxsize:
+            mapping.popitem(last=False)
+
+color_engine = ColorEngine()
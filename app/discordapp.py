@@ -1,14 +1,33 @@
 import discord
+from typing import Callable
 from app.pagination import Pagination
+from app.pagecache import page_cache
+from app.fieldsource import FieldSource
+from app.metrics import embed_render_seconds
 
 class DiscordApp():
-    def __init__(self, data: dict):
-        fields = data.pop("fields", None)
+    def __init__(self, data: dict, source: FieldSource = None):
+        fields = data.pop("fields", None) or []
         self._dict = data
         self.fields = fields
+        self.source = source or FieldSource.from_fields(fields)
         self.embed = discord.Embed()
+        self.pages = []
+        self.per_page = 10
+        self.key = page_cache.new_key()
         self.dict_to_embed()
 
+    @classmethod
+    def from_result(cls, key: str, result: dict, source: FieldSource):
+        """Rebuild a reply from its page cache entry to render one of its pages again"""
+
+        object = cls({}, source)
+        object.key = key
+        object.embed = discord.Embed.from_dict(result["embed"])
+        object.per_page = result["per_page"]
+        object.pages = [None] * result["total_pages"]
+        return object
+
     def dict_to_embed(self):
         """Convert a Python dictionary to a standard embed message"""
         
@@ -27,38 +46,108 @@ class DiscordApp():
         self.embed.set_thumbnail(url=self._dict.get("thumbnail", None))
         self.embed.timestamp = self._dict.get("timestamp", None)
         
-        self.set_fields()
-        
         if "footer" in self._dict:
             if "text" in self._dict["footer"]:
                 self.embed.set_footer(text=self._dict["footer"]["text"])
             if "icon_url" in self._dict["footer"]:
                 self.embed.set_footer(icon_url=self._dict["footer"]["icon_url"])
                 
-    def set_fields(self):
-        count = min(len(self.fields) - 1, 24) # max 25 fields per embed
-        for field in self.fields[0:count]:
-            self.embed.add_field(name=field["name"], value=field["value"], inline=field["inline"])
+    async def render_page(self, page: int, persist: bool = True) -> discord.Embed:
+        """Return the finished embed of a page, rendering it on first visit
         
-    async def fields_pagination(self, interaction: discord.Interaction, L: int = 10):
-        """Apply pagination to fields"""
+        Rendered pages are never modified afterwards, so they can be sent again as is.
+        New pages are stored in the page cache unless ``persist`` is false
+        """
         
-        if not self.fields:
-            await interaction.response.send_message(content="You have no records", embed=self.embed)
-            
-        async def get_page(page: int):
-            # Clear current fields
-            self.embed.clear_fields()
+        embed = self.pages[page-1]
+        if embed is not None:
+            return embed
+        
+        offset = (page-1) * self.per_page
+        fields = await self.source.get(offset, offset+self.per_page)
+        self.trim_pages(page)
+        
+        with embed_render_seconds.time():
+            # Start from a copy without fields so the shared base embed is never mutated
+            base = self.embed.to_dict()
+            base.pop("fields", None)
+            embed = discord.Embed.from_dict(base)
             
-            # Add new fields to embed
-            offset = (page-1) * L
-            for field in self.fields[offset:offset+L]:
-                self.embed.add_field(name=field["name"], value=field["value"], inline=field["inline"])
+            # Add page fields to embed
+            for field in fields:
+                embed.add_field(name=field.name, value=field.value, inline=field.inline)
             
             # Set footer to display current page
-            n = Pagination.compute_total_pages(len(self.fields), L)
-            self.embed.set_footer(text=f"Page {page} of {n}")
+            embed.set_footer(text=f"Page {page} of {len(self.pages)}")
+        
+        self.pages[page-1] = embed
+        if persist:
+            await page_cache.set(self.key, page, embed.to_dict())
+        return embed
+
+    def trim_pages(self, keep: int = 1):
+        """Drop the pages past the streamed total, which may shrink once Spotify returns a short window
+
+        The footers of the pages rendered so far show the old total, so they are
+        rendered again. The first ``keep`` pages are never dropped
+        """
+
+        n = max(Pagination.compute_total_pages(self.source.total, self.per_page), keep)
+        if n < len(self.pages):
+            self.pages = [None] * n
+
+    async def cache_loaded_pages(self, limit: int = 5):
+        """Render the first pages whose fields are already loaded, so the first clicks are served from the page cache"""
+        
+        last = min(len(self.pages), Pagination.compute_total_pages(self.source.loaded, self.per_page), limit)
+        embeds = {}
+        for page in range(1, last+1):
+            embeds[page] = (await self.render_page(page, persist=False)).to_dict()
+        await page_cache.set_many(self.key, embeds)
+        
+    async def fields_pagination(self, interaction: discord.Interaction, L: int = 10, on_first_page: Callable = None, result: dict = None):
+        """Apply pagination to fields
+        
+        The first page is sent as soon as it is rendered, the navigation buttons are
+        attached once the window after it has loaded, or right away if every field is
+        already loaded. ``result`` (the command and its
+        parameters) is saved in the page cache to render unseen pages on a later click
+        """
+        
+        if not self.source.total:
+            await Pagination.reply(interaction, content="You have no records", embed=self.embed)
+            if on_first_page is not None:
+                on_first_page()
+            return
+        
+        self.per_page = L
+        self.pages = [None] * Pagination.compute_total_pages(self.source.total, L)
             
-            return self.embed, n
+        # Kept off the time to first page, ready() stores it with the next pages in one batch
+        async def get_page(page: int):
+            embed = await self.render_page(page, persist=False)
+            return embed, len(self.pages)
 
-        await Pagination(interaction, get_page).navigate()
\ No newline at end of file
+        async def ready():
+            await self.source.ready()
+            self.trim_pages()
+            await self.cache_loaded_pages()
+            
+            # Everything a button click needs once this object is gone
+            await page_cache.set_result(self.key, {
+                **(result or {}),
+                "owner": interaction.user.id,
+                "embed": self.embed.to_dict(),
+                "per_page": L,
+                "total": self.source.total,
+                "total_pages": Pagination.compute_total_pages(self.source.total, L)
+            })
+
+        pagination = Pagination(interaction, self.key, get_page)
+        if self.source.pending:
+            await pagination.navigate(ready=ready, on_first_page=on_first_page)
+            return
+        
+        # Nothing left to load, the first page is sent once with its buttons
+        await ready()
+        await pagination.navigate(on_first_page=on_first_page)
\ No newline at end of file
@@ -0,0 +1,132 @@
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from app.loggerFyTops import logger
+
+class FieldSource():
+    """Embed fields streamed from Spotify in ``offset`` windows
+
+    Only the first window is fetched up front, further windows are fetched as the
+    user navigates, and the window after the one being viewed is prefetched in
+    the background
+    """
+
+    def __init__(self, fetch: Optional[Callable[[int, int], Awaitable[dict]]] = None, window: int = 20):
+        """
+        Create a streaming field source
+
+        Attributes
+        ---
+        fetch: :class:`Callable`
+            coroutine function taking ``limit`` and ``offset`` and returning a formatted
+            dictionary with ``fields`` and ``total`` keys
+        window: :class:`int`
+            number of items requested per Spotify call (at most 50)
+        """
+
+        self.fetch = fetch
+        self.window = window
+        self.total = 0
+        self._windows = {}
+        self._tasks = {}
+
+    @classmethod
+    def from_fields(cls, fields: list):
+        """Create a source from fields that are already loaded"""
+
+        source = cls(window=max(len(fields), 1))
+        source.total = len(fields)
+        source._windows[0] = fields
+        return source
+
+    async def start(self) -> dict:
+        """Fetch the first window and return its formatted dictionary (without fields)"""
+
+        formatted = await self.fetch(limit=self.window, offset=0)
+        fields = formatted.pop("fields")
+        self._windows[0] = fields
+        self.total = self.__clamp_total(formatted.pop("total", len(fields)), 0, fields)
+        self.prefetch(1)
+        return formatted
+
+    async def get(self, start: int, stop: int) -> list:
+        """Return fields ``start`` to ``stop``, fetching the windows covering them if needed"""
+
+        stop = min(stop, self.total)
+        if start >= stop:
+            return []
+
+        first, last = start // self.window, (stop - 1) // self.window
+        windows = await asyncio.gather(*(self.__load(index) for index in range(first, last + 1)))
+        self.prefetch(last + 1)
+
+        # Only slice the requested fields, lazily formatted windows format nothing else
+        fields = []
+        for index, window in enumerate(windows, first):
+            offset = index * self.window
+            fields.extend(window[max(start - offset, 0):stop - offset])
+        return fields
+
+    @property
+    def loaded(self) -> int:
+        """Number of leading fields available without fetching"""
+
+        index = 0
+        while index in self._windows:
+            index += 1
+        return min(index * self.window, self.total)
+
+    @property
+    def pending(self) -> bool:
+        """Whether windows are loading in the background"""
+
+        return bool(self._tasks)
+
+    async def ready(self):
+        """Wait for the windows currently loading in the background, ignoring their errors"""
+
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def prefetch(self, index: int):
+        """Start loading a window in the background"""
+
+        if self.fetch is None or index * self.window >= self.total:
+            return
+        if index in self._windows or index in self._tasks:
+            return
+
+        task = asyncio.create_task(self.__fetch_window(index))
+        task.add_done_callback(self.__log_prefetch_error)
+        self._tasks[index] = task
+
+    async def __load(self, index: int) -> list:
+        if index in self._windows:
+            return self._windows[index]
+
+        if index not in self._tasks:
+            self._tasks[index] = asyncio.create_task(self.__fetch_window(index))
+
+        return await self._tasks[index]
+
+    async def __fetch_window(self, index: int) -> list:
+        try:
+            offset = index * self.window
+            formatted = await self.fetch(limit=self.window, offset=offset)
+            fields = formatted["fields"]
+            self.total = self.__clamp_total(formatted.get("total", self.total), offset, fields)
+            self._windows[index] = fields
+            return fields
+        finally:
+            self._tasks.pop(index, None)
+
+    def __clamp_total(self, total: int, offset: int, fields: list) -> int:
+        # Spotify may report more items than it actually returns
+        if len(fields) < self.window:
+            return min(total, offset + len(fields))
+        return total
+
+    @staticmethod
+    def __log_prefetch_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Prefetching embed fields failed: %s", task.exception())
@@ -0,0 +1,91 @@
+import calendar
+from datetime import datetime
+from collections.abc import Sequence
+from typing import Any, Callable
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError: # orjson is optional, fall back to the standard library
+    import json
+    loads = json.loads
+
+class EmbedField():
+    """A single embed field"""
+
+    __slots__ = ("name", "value", "inline")
+
+    def __init__(self, name: str, value: str, inline: bool = False):
+        self.name = name
+        self.value = value
+        self.inline = inline
+
+    def __repr__(self) -> str:
+        return f"EmbedField(name={self.name!r}, value={self.value!r}, inline={self.inline!r})"
+
+class LazyFields(Sequence):
+    """Embed fields formatted from raw Spotify items on first access
+
+    Only the fields of pages actually displayed are ever formatted, so the cost
+    of a reply does not grow with the number of items fetched
+    """
+
+    __slots__ = ("_items", "_format", "_start", "_fields")
+
+    def __init__(self, items: list, format: Callable[[int, Any], EmbedField], start: int = 1):
+        """
+        Create a lazily formatted field sequence
+
+        Attributes
+        ---
+        items: :class:`list`
+            raw items, e.g. ``items`` of a Spotify response
+        format: :class:`Callable`
+            builds the :class:`EmbedField` of an item from its position and the item
+        start: :class:`int`
+            position of the first item, e.g. the rank of the first artist
+        """
+
+        self._items = items
+        self._format = format
+        self._start = start
+        self._fields = [None] * len(items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._items)))]
+
+        field = self._fields[index]
+        if field is None:
+            index = index % len(self._items)
+            field = self._fields[index] = self._format(self._start + index, self._items[index])
+        return field
+
+def iso_to_unix(time: str) -> int:
+    """Convert a UTC ISO-8601 timestamp such as ``2025-06-01T12:34:56.789Z`` to unix seconds"""
+    return iso_to_ms(time) // 1000
+
+def iso_to_ms(time: str) -> int:
+    """Convert a UTC ISO-8601 timestamp such as ``2025-06-01T12:34:56.789Z`` to unix milliseconds
+
+    Spotify's fixed ``Z`` format is parsed by slicing, anything else falls back to
+    :meth:`datetime.fromisoformat`
+    """
+
+    if len(time) < 20 or time[-1] != "Z" or time[10] != "T":
+        return round(datetime.fromisoformat(time).timestamp() * 1000)
+
+    seconds = calendar.timegm((
+        int(time[0:4]), int(time[5:7]), int(time[8:10]),
+        int(time[11:13]), int(time[14:16]), int(time[17:19]),
+        0, 0, 0
+    ))
+
+    milliseconds = 0
+    if time[19] == ".":
+        milliseconds = int((time[20:-1] + "00")[:3])
+
+    return seconds * 1000 + milliseconds
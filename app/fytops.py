@@ -1,19 +1,45 @@
-import os
-import spotipy
+import time
+import json
+import asyncio
+import aiohttp
+import hashlib
 import discord
+from io import BytesIO
+from typing import Literal
 from discord.ext import commands
 from urllib.parse import urlparse, parse_qs
 
 from app.discordapp import DiscordApp
+from app.pagination import Pagination, PageButton
+from app.pagecache import page_cache
+from app.collage import card_renderer
+from app.leaderboard import leaderboards, MEMBER_LIMIT
+from app.fieldsource import FieldSource
 from app.spotifyapp import SpotifyAppOAuth, SpotifyApp
+from app.spotifyclient import SpotifyClient, SpotifyException, SpotifyOauthError, is_transient, is_revoked
+from app.colorengine import color_engine
+from app.tokenstore import token_store
+from app.sharedcache import shared_cache
+from app.tokenrefresher import TokenRefresher
+from app.history import HistoryIngester, play_history
+from app.backend import CallbackServer
+from app.metrics import command_stage_seconds, commands_total
+from app.startup import startup
+from app.admission import admission, AdmissionRejected
 from app.loggerFyTops import logger
 
-GUILD_ID = discord.Object(id=1374160501390446625)
+# Seconds Discord gives a bot to acknowledge an interaction
+INTERACTION_TIMEOUT = 3
 
-class FyTops(commands.Bot):
-    """A Discord Bot to display user's Spotify account data"""
+class FyTops(commands.AutoShardedBot):
+    """A Discord Bot to display user's Spotify account data
     
-    def __init__(self, client_id, client_secret, redirect_uri):
+    Several processes may each run a range of shards (see :mod:`app.launcher`),
+    only the primary one syncs commands and runs the background refresh jobs
+    """
+    
+    def __init__(self, client_id, client_secret, redirect_uri, callback_host="0.0.0.0", callback_port=5000,
+                 shard_ids=None, shard_count=None, primary=True, dev_guild_id=None):
         """
         Create an instance of Discord bot FyTops
 
@@ -25,27 +51,134 @@ class FyTops(commands.Bot):
             Must be supplied or set as environment variable
         redirect_uri:
             Must be supplied or set as environment variable
+        callback_host:
+            Interface the OAuth callback server listens on
+        callback_port:
+            Port the OAuth callback server listens on
+        shard_ids:
+            Shards run by this process, all of them if not supplied
+        shard_count:
+            Total number of shards across every process, Discord's recommendation if not supplied
+        primary:
+            Whether this process syncs commands, refreshes tokens and ingests listening history
+        dev_guild_id:
+            Sync commands to this guild only instead of globally, for development
         """
         
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
+        self.primary = primary
+        self.dev_guild = discord.Object(id=dev_guild_id) if dev_guild_id else None
         
         intents = discord.Intents.default()
         intents.message_content = True
-        super().__init__(command_prefix="!", intents=intents)
+        super().__init__(command_prefix="!", intents=intents, shard_ids=shard_ids, shard_count=shard_count)
         
+        self.token_refresher = TokenRefresher(self.__create_auth_manager)
+        self.history_ingester = HistoryIngester(self.__create_auth_manager, play_history)
+        self.callback_server = CallbackServer(
+            client_secret,
+            self.__create_auth_manager,
+            self.__on_callback_login,
+            host=callback_host,
+            port=callback_port
+        )
         self.__setup_commands()
-               
-    async def on_ready(self):
-        logger.info(f"Logged on Discord as {self.user}")
+        self._ready_logged = False
+        startup.mark("init")
 
-        try:
-            synced = await self.tree.sync(guild=GUILD_ID)
-            logger.info(f"Synced {len(synced)} commands to guild {GUILD_ID.id}")
+    async def setup_hook(self):
+        # Navigation buttons of every earlier reply, whichever process sent it
+        self.add_dynamic_items(PageButton)
         
+        if self.primary:
+            self.token_refresher.start()
+            self.history_ingester.start()
+            page_cache.start()
+            card_renderer.start()
+        await self.callback_server.start()
+        startup.mark("setup_hook")
+
+        # Commands are global, registering them once is enough
+        if self.primary:
+            await self.sync_commands()
+            startup.mark("command_sync")
+
+    async def sync_commands(self):
+        """Register the slash commands with Discord, only if they changed since the last sync
+
+        Each sync is a rate-limited API call, a hash of the registered commands is
+        kept in the shared cache so restarts and reconnects skip it
+        """
+
+        # While developing, commands are only registered to a test guild where they update instantly
+        if self.dev_guild is not None:
+            self.tree.copy_global_to(guild=self.dev_guild)
+        scope = self.dev_guild.id if self.dev_guild is not None else "global"
+
+        payload = [command.to_dict(self.tree) for command in self.tree.get_commands(guild=self.dev_guild)]
+        digest = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+        key = f"{self.application_id}:{scope}"
+
+        if await asyncio.to_thread(shared_cache.get, "command_sync", key) == digest:
+            logger.info("Commands unchanged since the last sync (%s), skipping it", scope)
+            return
+
+        try:
+            synced = await self.tree.sync(guild=self.dev_guild)
         except Exception as e:
-            logger.error(f"Error syncing commands: {e}")
+            logger.error("Error syncing commands: %s", e)
+            return
+
+        await asyncio.to_thread(shared_cache.set, "command_sync", key, digest)
+        logger.info("Synced %d commands (%s)", len(synced), scope)
+
+    async def on_ready(self):
+        logger.info("Logged on Discord as %s with shards %s of %s", self.user, sorted(self.shards), self.shard_count)
+
+        # on_ready fires again after a reconnect that could not resume
+        if not self._ready_logged:
+            self._ready_logged = True
+            startup.mark("gateway")
+            logger.info(startup.summary())
+
+    async def on_shard_ready(self, shard_id: int):
+        logger.info("Shard %s ready", shard_id)
+
+    async def on_interaction(self, interaction: discord.Interaction):
+        # /server-top only looks up the users seen in the guild, not every linked user
+        if interaction.guild_id is not None:
+            token_store.remember_guild(interaction.user.id, interaction.guild_id)
+
+    async def close(self):
+        await self.callback_server.stop()
+        await self.token_refresher.stop()
+        await self.history_ingester.stop()
+        await page_cache.stop()
+        await card_renderer.stop()
+        await SpotifyClient.close_session()
+        color_engine.shutdown()
+        token_store.close()
+        shared_cache.close()
+        play_history.close()
+        await super().close()
+
+    async def __on_callback_login(self, user_id: int):
+        """A user linked their Spotify account through the OAuth callback"""
+
+        self.token_refresher.schedule(user_id)
+        self.dispatch("spotify_login", user_id)
+
+    async def on_spotify_login(self, user_id: int):
+        """Confirm a login completed in the browser to the user in their DMs"""
+
+        try:
+            embed = await self.login_embed(self.__create_auth_manager(user_id))
+            user = self.get_user(user_id) or await self.fetch_user(user_id)
+            await user.send(embed=embed)
+        except (discord.HTTPException, SpotifyException) as e: # DMs closed, or Spotify unavailable
+            logger.warning("%s: Unable to confirm login in DMs: %s", user_id, e)
 
     async def on_message(self, message: discord.Message):
         if message.author == self.user:
@@ -75,54 +208,298 @@ class FyTops(commands.Bot):
             
             user_id = interaction.user.id
             
-            logger.info(f"{user_id}: User requesting /{command}")
+            logger.info("%s: User requesting /%s", user_id, command)
+
+            try:
+                with command_stage_seconds.time(command=command, stage="total"):
+                    async with admission.admit(user_id, self.interaction_deadline(interaction)):
+                        outcome = await __handle_command(command, interaction, time_range)
+            except AdmissionRejected as e:
+                await self.__shed(command, interaction, e)
+                return
+            except Exception:
+                commands_total.inc(command=command, outcome="error")
+                raise
+
+            commands_total.inc(command=command, outcome=outcome)
+
+        async def __handle_command(command: str, interaction: discord.Interaction, time_range: str) -> str:
+            """Run each stage of a command, timing them, and return the command outcome"""
+
+            user_id = interaction.user.id
+            started = time.perf_counter()
 
             # Check user authentication
-            notLogin = self.check_authentication(user_id)
+            with command_stage_seconds.time(command=command, stage="auth"):
+                notLogin = self.check_authentication(user_id)
             if notLogin:
                 await interaction.response.send_message(embed=notLogin)
-                logger.warning(f"{user_id}: Unable to proceed request due to unexisted or invalid access token")
-                return
+                logger.warning("%s: Unable to proceed request due to unexisted or invalid access token", user_id)
+                return "not_logged_in"
             
-            # Request and format data from Spotify
-            auth_manager = self.__create_auth_manager(user_id)
-            object = SpotifyApp(auth_manager=auth_manager)
+            # Acknowledge right away, Spotify may take longer than Discord's 3 second deadline
+            with command_stage_seconds.time(command=command, stage="defer"):
+                await interaction.response.defer(thinking=True)
             
-            commands_map = {
-                "artists": object.format_top_artists,
-                "tracks": object.format_top_tracks,
-                "recent": object.format_recent
-            }
-            
-            # Call appropriate request and convert data to standard format
-            # /recent does not accept parameter "time_range"
             try:
-                formatted = commands_map[command](limit=50, time_range=time_range)
-            except:
-                formatted = commands_map[command](limit=50)
+                # Request and format data from Spotify
+                with command_stage_seconds.time(command=command, stage="spotify"):
+                    auth_manager = self.__create_auth_manager(user_id)
+                    object = SpotifyApp(auth_manager)
+                    
+                    # Call appropriate request and convert data to standard format
+                    # /recent is read from the local history in one go
+                    if command == "recent":
+                        source = None
+                        load = object.format_recent(limit=200)
+                    
+                    # Top lists are streamed, further windows are fetched as the user navigates
+                    else:
+                        source = FieldSource(self.__fetch_fields(object, command, time_range), window=20)
+                        load = source.start()
+                    
+                    # The profile and the first window are fetched concurrently
+                    _, formatted = await asyncio.gather(object.load_user_info(), load)
+                    formatted.update(object.user_info)
+                    
+                    # A later click pages through the same plays, see render_result_page
+                    result = {"command": command, "time_range": time_range}
+                    if "before" in formatted:
+                        result["before"] = formatted.pop("before")
+                    
+                    if source is None:
+                        source = FieldSource.from_fields(formatted["fields"])
+            
+            # Refresh token invalid - user revoked authentication
+            except SpotifyOauthError as e:
+                if not is_revoked(e):
+                    await Pagination.reply(interaction, embed=self.unavailable_embed())
+                    logger.warning("%s: Token request failed, keeping the token: %s", user_id, e)
+                    return "unavailable"
+                
+                await self.token_refresher.evict(user_id)
+                await Pagination.reply(interaction, embed=self.check_authentication(user_id))
+                logger.warning("%s: Invalid acccess token due to user revoked app permission", user_id)
+                return "revoked"
+            
+            # Spotify is slow or down and nothing usable is cached
+            except (SpotifyException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not is_transient(e):
+                    await self.__reply_failure(interaction)
+                    raise
+                await Pagination.reply(interaction, embed=self.unavailable_embed())
+                logger.warning("%s: Spotify unavailable: %s", user_id, e)
+                return "unavailable"
+            
+            except Exception:
+                await self.__reply_failure(interaction)
+                raise
+                
             formatted["author"] = self.get_discord_user(interaction)
             
+            sent = False
+            def first_page_sent():
+                nonlocal sent
+                sent = True
+                command_stage_seconds.observe(time.perf_counter() - started, command=command, stage="first_page")
+            
             # Convert to embed and create a pagination system
-            data = DiscordApp(formatted)
-            await data.fields_pagination(interaction=interaction, L=10)
-            logger.info(f"{user_id}: Successfully returned API call request")
+            try:
+                with command_stage_seconds.time(command=command, stage="reply"):
+                    data = DiscordApp(formatted, source)
+                    await data.fields_pagination(
+                        interaction=interaction,
+                        L=10,
+                        on_first_page=first_page_sent,
+                        result=result
+                    )
+            
+            # A first page already shown is kept, only the buttons are missing
+            except Exception:
+                if not sent:
+                    await self.__reply_failure(interaction)
+                raise
+            
+            logger.info("%s: Successfully returned API call request", user_id)
+            return "ok"
+
+        async def __card_call(interaction: discord.Interaction, kind: str, time_range: str, grid: int):
+            """Reply with a collage of the artwork of the user's top artists or tracks"""
+            
+            user_id = interaction.user.id
+            logger.info("%s: User requesting /card %s", user_id, kind)
+            
+            with command_stage_seconds.time(command="card", stage="auth"):
+                notLogin = self.check_authentication(user_id)
+            if notLogin:
+                await interaction.response.send_message(embed=notLogin)
+                commands_total.inc(command="card", outcome="not_logged_in")
+                return
+            
+            # Composing a new card takes longer than Discord's 3 second deadline
+            with command_stage_seconds.time(command="card", stage="defer"):
+                await interaction.response.defer(thinking=True)
+            
+            try:
+                object = SpotifyApp(self.__create_auth_manager(user_id))
+                time_range = object.alias_time_range(time_range)
+                
+                with command_stage_seconds.time(command="card", stage="spotify"):
+                    await object.load_user_info()
+                    formatted = {
+                        **object.user_info,
+                        "title": object.time_range_definition(f"Top {kind.capitalize()}", time_range)
+                    }
+                
+                # A recent card of the same list is reused as is
+                with command_stage_seconds.time(command="card", stage="render"):
+                    content = await card_renderer.cached(user_id, kind, time_range, grid)
+                    if content is None:
+                        card = await object.format_card(kind, time_range, grid)
+                        content = await card_renderer.render(user_id, kind, time_range, grid, card.pop("urls"), object.get_bytes)
+            
+            # Refresh token invalid - user revoked authentication
+            except SpotifyOauthError as e:
+                if not is_revoked(e):
+                    await Pagination.reply(interaction, embed=self.unavailable_embed())
+                    commands_total.inc(command="card", outcome="unavailable")
+                    logger.warning("%s: Token request failed, keeping the token: %s", user_id, e)
+                    return
+                
+                await self.token_refresher.evict(user_id)
+                await Pagination.reply(interaction, embed=self.check_authentication(user_id))
+                commands_total.inc(command="card", outcome="revoked")
+                return
+            
+            except (SpotifyException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not is_transient(e):
+                    commands_total.inc(command="card", outcome="error")
+                    await self.__reply_failure(interaction)
+                    raise
+                await Pagination.reply(interaction, embed=self.unavailable_embed())
+                commands_total.inc(command="card", outcome="unavailable")
+                logger.warning("%s: Spotify unavailable: %s", user_id, e)
+                return
+            
+            except Exception:
+                commands_total.inc(command="card", outcome="error")
+                await self.__reply_failure(interaction)
+                raise
+            
+            formatted["author"] = self.get_discord_user(interaction)
+            formatted["image"] = "attachment://card.jpg"
+            
+            with command_stage_seconds.time(command="card", stage="reply"):
+                data = DiscordApp(formatted)
+                await interaction.edit_original_response(embed=data.embed, attachments=[discord.File(BytesIO(content), filename="card.jpg")])
+            
+            commands_total.inc(command="card", outcome="ok")
+            logger.info("%s: Successfully returned a %dx%d card", user_id, grid, grid)
+
+        async def __server_top_call(interaction: discord.Interaction, kind: str, time_range: str):
+            """Reply with the top artists or tracks of the server's linked members"""
+            
+            user_id = interaction.user.id
+            guild = interaction.guild
+            logger.info("%s: User requesting /server-top %s", user_id, kind)
+            
+            # Merging many members' lists may take longer than Discord's 3 second deadline
+            with command_stage_seconds.time(command="server-top", stage="defer"):
+                await interaction.response.defer(thinking=True)
+            
+            try:
+                time_range = SpotifyApp.alias_time_range(time_range)
+                
+                with command_stage_seconds.time(command="server-top", stage="members"):
+                    members = await leaderboards.linked_members(guild, token_store.guild_user_ids)
+                
+                # Only the members' lists are needed, no profile or color
+                with command_stage_seconds.time(command="server-top", stage="spotify"):
+                    board = leaderboards.board(guild.id, kind, time_range)
+                    failed = await leaderboards.refresh(
+                        board, 
+                        members, 
+                        lambda member: SpotifyApp(self.__create_auth_manager(member)).top_items(kind, time_range, limit=MEMBER_LIMIT)
+                    )
+                    top = board.top(10)
+            
+            except Exception:
+                commands_total.inc(command="server-top", outcome="error")
+                await self.__reply_failure(interaction)
+                raise
+            
+            if not top:
+                await Pagination.reply(interaction, embed=discord.Embed(
+                    color=discord.Color.orange(),
+                    description="No member of this server has linked a Spotify account yet, use `/login` to be the first!"
+                ))
+                commands_total.inc(command="server-top", outcome="empty")
+                return
+            
+            embed = discord.Embed(
+                color=discord.Color.green(),
+                title=SpotifyApp.time_range_definition(f"Server Top {kind.capitalize()}", time_range),
+                description=f"Based on {board.contributors} of {len(members)} linked members of **{guild.name}**"
+            )
+            if guild.icon is not None:
+                embed.set_thumbnail(url=guild.icon.url)
+            
+            for rank, (item, score, count) in enumerate(top, start=1):
+                name = item["name"] if kind == "artists" else f"{item['name']} - {', '.join(item['artists'])}"
+                embed.add_field(
+                    name=f"{SpotifyApp.rank_emojify(rank)} {name}",
+                    value=f"[{kind[:-1].capitalize()} on Spotify]({item['url']}) in the top of {count} member{'s' if count > 1 else ''}",
+                    inline=False
+                )
+            
+            with command_stage_seconds.time(command="server-top", stage="reply"):
+                await Pagination.reply(interaction, embed=embed)
+            
+            commands_total.inc(command="server-top", outcome="partial" if failed else "ok")
+            logger.info("%s: Successfully returned the server top of %d members (%d skipped)", user_id, len(members), failed)
 
-        @self.tree.command(name="artists", description="See your most listened artists", guild=GUILD_ID)
+        @self.tree.command(name="artists", description="See your most listened artists")
         @discord.app_commands.describe(time_range="Over what time frame the data are computed")
         async def top_artists(interaction: discord.Interaction, time_range: str="medium_term"):       
             await __command_call("artists", interaction, time_range)
 
-        @self.tree.command(name="tracks", description="See your most listened tracks", guild=GUILD_ID)
+        @self.tree.command(name="tracks", description="See your most listened tracks")
         @discord.app_commands.describe(time_range="Over what time frame the data are computed")
         async def top_tracks(interaction: discord.Interaction, time_range: str="medium_term"):
             await __command_call("tracks", interaction, time_range)
 
-        @self.tree.command(name="recent", description="See your recent tracks", guild=GUILD_ID)
+        @self.tree.command(name="recent", description="See your recent tracks")
         async def recent(interaction: discord.Interaction):
             await __command_call("recent", interaction, "none")      
         
         
-        @self.tree.command(name="login", description="Log in your Spotify account", guild=GUILD_ID)
+        @self.tree.command(name="card", description="See your top artists or tracks as an image card")
+        @discord.app_commands.describe(
+            kind="Artists or tracks",
+            time_range="Over what time frame the data are computed",
+            size="Number of rows and columns of the grid"
+        )
+        async def card(interaction: discord.Interaction, kind: Literal["artists", "tracks"]="tracks", time_range: str="medium_term", size: Literal[3, 5]=3):
+            try:
+                async with admission.admit(interaction.user.id, self.interaction_deadline(interaction)):
+                    await __card_call(interaction, kind, time_range, size)
+            except AdmissionRejected as e:
+                await self.__shed("card", interaction, e)
+        
+        @self.tree.command(name="server-top", description="See the most listened artists or tracks of this server")
+        @discord.app_commands.guild_only()
+        @discord.app_commands.describe(
+            kind="Artists or tracks",
+            time_range="Over what time frame the data are computed"
+        )
+        async def server_top(interaction: discord.Interaction, kind: Literal["artists", "tracks"]="artists", time_range: str="medium_term"):
+            try:
+                async with admission.admit(interaction.user.id, self.interaction_deadline(interaction)):
+                    await __server_top_call(interaction, kind, time_range)
+            except AdmissionRejected as e:
+                await self.__shed("server-top", interaction, e)
+        
+        @self.tree.command(name="login", description="Log in your Spotify account")
         async def login(interaction: discord.Interaction):
             """Check Spotify account login information"""
             
@@ -140,59 +517,68 @@ class FyTops(commands.Bot):
                 auth_url = auth_manager.get_authorize_url()
                 embed = discord.Embed(
                     color=discord.Color.yellow(),
-                    description=f"Click [here]({auth_url}) to link your Spotify account with the current Discord account"
+                    description=f"Click [here]({auth_url}) to link your Spotify account with the current Discord account, the link expires in {SpotifyAppOAuth.STATE_TTL // 60} minutes"
                 )
 
             await interaction.response.send_message(embed=embed, ephemeral=True)
 
-        @self.tree.command(name="auth", description="Provide authentication code", guild=GUILD_ID)
+        @self.tree.command(name="auth", description="Provide authentication code")
         async def auth(interaction: discord.Interaction, code: str):
             """Manually retrieve authorization code from user"""
             
             user_id = interaction.user.id
             auth_manager = self.__create_auth_manager(user_id)
             
-            notLogin = self.check_authentication(user_id)
-            if notLogin:
-                # Retrieve the auth code
-                try:
-                    parsed_url = urlparse(code)
-                    query_params = parse_qs(parsed_url.query)
-                    auth_code = query_params.get('code')[0]
-                except: # if failed to parse the query then try using the original content
-                    auth_code = code
-                
-                # Exchange auth code for token
-                try:
-                    auth_manager.get_access_token(code=auth_code, as_dict=False)
-                except spotipy.exceptions.SpotifyOauthError as e:
-                    logger.error(f"Token exchange error: {e}")
-                    embed = discord.Embed(
-                        color=discord.Color.red(),
-                        description="❌ Invalid authorization code, please try again!"
-                    )
+            # Acknowledge right away, the code exchange and the profile may take longer than Discord's 3 second deadline
+            await interaction.response.defer(ephemeral=True, thinking=True)
+            
+            try:
+                notLogin = self.check_authentication(user_id)
+                if notLogin:
+                    # Retrieve the auth code
+                    try:
+                        parsed_url = urlparse(code)
+                        query_params = parse_qs(parsed_url.query)
+                        auth_code = query_params.get('code')[0]
+                    except: # if failed to parse the query then try using the original content
+                        auth_code = code
                     
-                    await interaction.response.send_message(embed=embed, ephemeral=True)
-                    return
+                    # Exchange auth code for token, the linked account may have changed
+                    await SpotifyApp.invalidate_user(user_id)
+                    try:
+                        await auth_manager.get_access_token_async(code=auth_code)
+                    except SpotifyOauthError as e:
+                        logger.error("Token exchange error: %s", e)
+                        embed = discord.Embed(
+                            color=discord.Color.red(),
+                            description="❌ Invalid authorization code, please try again!"
+                        )
+                        
+                        await Pagination.reply(interaction, embed=embed)
+                        return
+                    
+                    self.token_refresher.schedule(user_id)
 
-            # Get Spotify account info if authentication successful
-            object = SpotifyApp(auth_manager=auth_manager)
-            description = object.user_info["description"].splitlines()[0]
-            thumbnail = object.user_info["thumbnail"]
-              
-            # Construct embed message
-            embed = discord.Embed(
-                color=discord.Color.green(),
-                title="✅ You have successfully logged in as",
-                description=description,
-            )
+                # Get Spotify account info if authentication successful
+                embed = await self.login_embed(auth_manager)
             
-            embed.set_thumbnail(url=thumbnail)
+            # Spotify is slow or down, the same code or /auth can be tried again
+            except (SpotifyException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not is_transient(e):
+                    await self.__reply_failure(interaction)
+                    raise
+                await Pagination.reply(interaction, embed=self.unavailable_embed())
+                logger.warning("%s: Spotify unavailable during authentication: %s", user_id, e)
+                return
             
-            logger.info(f"{user_id}: Valid authorization code, access token successfully created")
-            await interaction.response.send_message(embed=embed, ephemeral=True)
+            except Exception:
+                await self.__reply_failure(interaction)
+                raise
             
-        @self.tree.command(name="logout", description="Log out your current Spotify account", guild=GUILD_ID)
+            logger.info("%s: Valid authorization code, access token successfully created", user_id)
+            await Pagination.reply(interaction, embed=embed)
+            
+        @self.tree.command(name="logout", description="Log out your current Spotify account")
         async def logout(interaction: discord.Interaction):
             """Remove Spotify account linkage with current Discord user"""
             
@@ -203,15 +589,13 @@ class FyTops(commands.Bot):
                 description="✅ You have logged out of your Spotify account",
             )
             
-            try:
-                os.remove(SpotifyAppOAuth.get_user_cache_path(user_id))
-            except:
-                pass
+            await self.token_refresher.evict(user_id)
+            await asyncio.to_thread(play_history.delete, user_id)
         
-            logger.debug(f"{user_id}: Logged out Spotify account, access token removed")
+            logger.debug("%s: Logged out Spotify account, access token removed", user_id)
             await interaction.response.send_message(embed=embed, ephemeral=True)
 
-        @self.tree.command(name="help", description="How to use FyTops", guild=GUILD_ID)
+        @self.tree.command(name="help", description="How to use FyTops")
         async def help(interaction: discord.Interaction):
             menu ='''     
 Hello, my name is **FyTops**, I am a bot developed by <@1181768796592156712> to help you access statistics of your Spotify account.
@@ -220,6 +604,8 @@ Hello, my name is **FyTops**, I am a bot developed by <@1181768796592156712> to
 `/artists <time_range>`: Show a list of your most listened Spotify artists.
 `/tracks <time_range>`: Show a list of your most listened Spotify tracks.
 `/recent`: Show your most recently listened tracks on Spotify.
+`/server-top <kind> <time_range>`: Show the most listened artists or tracks of the server's linked members.
+`/card <kind> <time_range> <size>`: Show your top tracks or artists as an image card, `<size>` can be `3` or `5` rows and columns.
 
 **Optional parameter**
 `<time_range>`: Set to `medium` by default, can be `short` (30 days), `medium` (6 months), or `long` (12 months). 
@@ -248,29 +634,106 @@ Hello, my name is **FyTops**, I am a bot developed by <@1181768796592156712> to
             return an empty string otherwise
         """
         
-        path = SpotifyAppOAuth.get_user_cache_path(user_id)
-
         embed = discord.Embed(
             color=discord.Color.red(),
             title="❌ You haven't logged in to your Spotify account!",
             description="Use `/login` to authenticate FyTops to your Spotify account"
         )
         
-        if os.path.exists(path):
-            try:
-                auth_manager = self.__create_auth_manager(user_id)
-                object = SpotifyApp(auth_manager=auth_manager)
-                object.me()
-                embed = None # clear error message if token is valid
-                logger.debug(f"{user_id}: Authentication validated, user access token valid")
-            
-            # Refresh token invalid - user revoked authentication
-            except spotipy.SpotifyOauthError as e:
-                os.remove(path)
-                logger.warning(f"{user_id}: Invalid acccess token due to user revoked app permission")
+        # Tokens are kept fresh by the token refresher and evicted once revoked,
+        # so a stored token is a valid login
+        if user_id in token_store:
+            embed = None # clear error message if token is valid
+            logger.debug("%s: Authentication validated, user access token stored", user_id)
 
         return embed
     
+    @staticmethod
+    def interaction_deadline(interaction: discord.Interaction) -> float:
+        """Return the :func:`time.monotonic` time by which Discord expects the interaction to be acknowledged"""
+
+        # Clamped, a skewed clock must not make every interaction look expired
+        age = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+        return time.monotonic() + INTERACTION_TIMEOUT - min(max(age, 0), 1)
+
+    async def __shed(self, command: str, interaction: discord.Interaction, error: AdmissionRejected):
+        """Tell the user a command was not admitted, while the interaction can still be answered"""
+
+        if error.reason == "user":
+            description = "⏳ You already have commands running, wait for them to finish."
+        else:
+            description = "⏳ FyTops is busy right now, please try again in a few seconds."
+        
+        commands_total.inc(command=command, outcome="busy")
+        logger.warning("%s: /%s shed by admission control (%s)", interaction.user.id, command, error.reason)
+        await interaction.response.send_message(embed=discord.Embed(color=discord.Color.orange(), description=description), ephemeral=True)
+
+    async def __reply_failure(self, interaction: discord.Interaction):
+        """Replace the "thinking" message of a failed command with an error, the caller raises the failure itself"""
+
+        try:
+            await Pagination.reply(interaction, embed=self.error_embed())
+        except discord.HTTPException as e:
+            logger.warning("%s: Unable to report a failed command: %s", interaction.user.id, e)
+
+    @staticmethod
+    def error_embed() -> discord.Embed:
+        return discord.Embed(
+            color=discord.Color.red(),
+            description="❌ Something went wrong, please try again later."
+        )
+
+    @staticmethod
+    def unavailable_embed() -> discord.Embed:
+        return discord.Embed(
+            color=discord.Color.orange(),
+            description="⚠️ Spotify is not responding right now, please try again in a minute."
+        )
+
+    async def login_embed(self, auth_manager: SpotifyAppOAuth) -> discord.Embed:
+        """Build the embed confirming which Spotify account is linked"""
+
+        object = await SpotifyApp.create(auth_manager=auth_manager)
+        description = object.user_info["description"].splitlines()[0]
+        thumbnail = object.user_info["thumbnail"]
+          
+        # Construct embed message
+        embed = discord.Embed(
+            color=discord.Color.green(),
+            title="✅ You have successfully logged in as",
+            description=description,
+        )
+        
+        embed.set_thumbnail(url=thumbnail)
+        return embed
+
+    async def render_result_page(self, key: str, result: dict, page: int) -> discord.Embed:
+        """Render a page of an earlier reply again, when it is missing from the page cache"""
+
+        # The stored embed already has the profile, only the fields are fetched
+        object = SpotifyApp(self.__create_auth_manager(result["owner"]))
+        source = FieldSource(self.__fetch_fields(object, result["command"], result["time_range"], result.get("before")), window=20)
+        source.total = result["total"]
+        
+        data = DiscordApp.from_result(key, result, source)
+        return await data.render_page(page)
+
+    @staticmethod
+    def __fetch_fields(object: SpotifyApp, command: str, time_range: str, before: int = None):
+        """Return the coroutine function fetching a window of a command's fields
+        
+        ``before`` is the newest play of a ``/recent`` reply, in unix milliseconds
+        """
+
+        if command == "recent":
+            return lambda limit, offset: object.format_recent(limit=limit, offset=offset, before=before)
+        
+        commands_map = {
+            "artists": object.format_top_artists,
+            "tracks": object.format_top_tracks
+        }
+        return lambda limit, offset: commands_map[command](limit=limit, offset=offset, time_range=time_range)
+
     def __create_auth_manager(self, user_id):
         return SpotifyAppOAuth(user_id, self.client_id, self.client_secret, self.redirect_uri)
     
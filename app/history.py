@@ -0,0 +1,341 @@
+import os
+import json
+import glob
+import time
+import asyncio
+import sqlite3
+import threading
+from array import array
+from typing import Callable, Optional
+
+from app.spotifyclient import SpotifyClient
+from app.tokenstore import TokenStore, token_store
+from app.singleflight import SingleFlight
+from app.formatters import iso_to_ms
+from app.loggerFyTops import logger
+
+class PlayHistory():
+    """Local store of every linked user's listening history, in a SQLite file shared by every worker process
+
+    Tracks and artists are interned once, a play is a (user, play time, track) row.
+    Plays are keyed by user and play time, so the same play ingested by several
+    processes is stored once.
+    """
+
+    def __init__(self, path: str = "history.db", legacy_dir: str = "history"):
+        """
+        Create a play history store, its file is opened (or created) on first use
+
+        Attributes
+        ---
+        path: :class:`str`
+            SQLite database file
+        legacy_dir: :class:`str`
+            directory of the interning tables and per-user column files of earlier
+            versions, imported by :meth:`migrate`
+        """
+
+        self.path = path
+        self.legacy_dir = legacy_dir
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def __connection(self) -> sqlite3.Connection:
+        """Return the connection, opening the database first if needed (called under the lock)"""
+
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS artists ("
+                "id INTEGER PRIMARY KEY, "
+                "spotify_id TEXT NOT NULL UNIQUE, "
+                "name TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tracks ("
+                "id INTEGER PRIMARY KEY, "
+                "spotify_id TEXT NOT NULL UNIQUE, "
+                "name TEXT NOT NULL, "
+                "url TEXT NOT NULL, "
+                "artists TEXT NOT NULL)" # JSON list of artist ids
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS plays ("
+                "user_id INTEGER NOT NULL, "
+                "played_at INTEGER NOT NULL, " # unix milliseconds
+                "track INTEGER NOT NULL, "
+                "PRIMARY KEY (user_id, played_at)) WITHOUT ROWID"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS deletions ("
+                "user_id INTEGER PRIMARY KEY, "
+                "deleted_at REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def __intern(conn: sqlite3.Connection, table: str, spotify_id: str, values: dict) -> int:
+        """Return the id of a track or artist row, inserting it first if needed (called in a transaction)"""
+
+        columns = ", ".join(("spotify_id", *values))
+        placeholders = ", ".join("?" * (len(values) + 1))
+        conn.execute(f"INSERT OR IGNORE INTO {table} ({columns}) VALUES ({placeholders})", (spotify_id, *values.values()))
+        return conn.execute(f"SELECT id FROM {table} WHERE spotify_id = ?", (spotify_id,)).fetchone()[0]
+
+    def __intern_track(self, conn: sqlite3.Connection, track: dict) -> int:
+        artists = [self.__intern(conn, "artists", artist["id"], {"name": artist["name"]}) for artist in track["artists"] if artist.get("id")]
+        return self.__intern(conn, "tracks", track["id"], {
+            "name": track["name"],
+            "url": track["external_urls"]["spotify"],
+            "artists": json.dumps(artists)
+        })
+
+    def last_played(self, user_id: int) -> Optional[int]:
+        with self._lock:
+            return self.__connection().execute("SELECT MAX(played_at) FROM plays WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+    def append(self, user_id: int, items: list, since: float = None) -> int:
+        """
+        Store recently played items, in a single transaction
+
+        Attributes
+        ---
+        user_id: :class:`int`
+            Discord id of the user
+        items: :class:`list`
+            ``items`` of a Spotify recently played response, in any order
+        since: :class:`float`
+            unix time the items were requested at, nothing is stored if the user's
+            history was deleted meanwhile
+
+        Returns
+        ---
+        :class:`int`
+            number of plays that were not stored yet
+        """
+
+        # Local files have no Spotify id
+        plays = [(iso_to_ms(item["played_at"]), item["track"]) for item in items if item.get("track") and item["track"].get("id")]
+        if not plays:
+            return 0
+
+        with self._lock:
+            conn = self.__connection()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                
+                # A logout while the items were being fetched must not bring the history back
+                if since is not None and conn.execute(
+                    "SELECT 1 FROM deletions WHERE user_id = ? AND deleted_at >= ?", (user_id, since)
+                ).fetchone():
+                    return 0
+                
+                rows = [(user_id, ms, self.__intern_track(conn, track)) for ms, track in plays]
+                before = conn.total_changes
+                conn.executemany("INSERT OR IGNORE INTO plays (user_id, played_at, track) VALUES (?, ?, ?)", rows)
+                return conn.total_changes - before
+
+    def delete(self, user_id: int):
+        """Forget a user's listening history"""
+
+        with self._lock:
+            conn = self.__connection()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("DELETE FROM plays WHERE user_id = ?", (user_id,))
+                conn.execute(
+                    "INSERT INTO deletions (user_id, deleted_at) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET deleted_at = excluded.deleted_at",
+                    (user_id, time.time())
+                )
+
+    def recent(self, user_id: int, limit: int = 50, offset: int = 0, before: int = None) -> list:
+        """
+        Return the most recent plays of a user, newest first
+
+        Attributes
+        ---
+        before: :class:`int`
+            only return plays at or before this time, in unix milliseconds, so
+            offsets stay stable while newer plays are appended
+
+        Returns
+        ---
+        :class:`list`
+            ``(played_at, track)`` tuples, ``played_at`` in unix seconds and ``track``
+            a dictionary with ``name``, ``url`` and ``artists`` names
+        """
+
+        if before is None:
+            before = 2 ** 63 - 1
+
+        with self._lock:
+            conn = self.__connection()
+            rows = conn.execute(
+                "SELECT plays.played_at, tracks.name, tracks.url, tracks.artists FROM plays "
+                "JOIN tracks ON tracks.id = plays.track "
+                "WHERE plays.user_id = ? AND plays.played_at <= ? ORDER BY plays.played_at DESC LIMIT ? OFFSET ?",
+                (user_id, before, limit, offset)
+            ).fetchall()
+
+            artist_ids = {artist for row in rows for artist in json.loads(row[3])}
+            names = dict(conn.execute(
+                f"SELECT id, name FROM artists WHERE id IN ({', '.join('?' * len(artist_ids))})",
+                tuple(artist_ids)
+            ).fetchall()) if artist_ids else {}
+
+        return [
+            (played_at // 1000, {"name": name, "url": url, "artists": [names[artist] for artist in json.loads(artists) if artist in names]})
+            for played_at, name, url, artists in rows
+        ]
+
+    def migrate(self):
+        """One-shot import of the JSON lines tables and binary columns of earlier versions
+
+        Run once before the workers start, a concurrent run is tolerated
+        """
+
+        legacy_dir = self.legacy_dir
+        if not os.path.isdir(legacy_dir):
+            return
+
+        def rows(name: str) -> list:
+            try:
+                with open(os.path.join(legacy_dir, name)) as f:
+                    return [json.loads(line) for line in f if line.strip()]
+            except (OSError, ValueError) as e:
+                logger.warning("Skipped %s during migration: %s", name, e)
+                return []
+
+        artists, tracks = rows("artists.jsonl"), rows("tracks.jsonl")
+        migrated = 0
+
+        with self._lock:
+            conn = self.__connection()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                artist_ids = [self.__intern(conn, "artists", artist["id"], {"name": artist["name"]}) for artist in artists]
+                track_ids = [
+                    self.__intern(conn, "tracks", track["id"], {
+                        "name": track["name"],
+                        "url": track["url"],
+                        "artists": json.dumps([artist_ids[artist] for artist in track["artists"] if artist < len(artist_ids)])
+                    })
+                    for track in tracks
+                ]
+
+                for path in glob.glob(os.path.join(legacy_dir, "*.played")):
+                    played_at, indices = array("q"), array("I")
+                    try:
+                        user_id = int(os.path.splitext(os.path.basename(path))[0])
+                        with open(path, "rb") as f:
+                            played_at.frombytes(f.read())
+                        with open(f"{path[:-len('.played')]}.tracks", "rb") as f:
+                            indices.frombytes(f.read())
+                    except (ValueError, OSError) as e:
+                        logger.warning("Skipped history file %s during migration: %s", path, e)
+                        continue
+
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO plays (user_id, played_at, track) VALUES (?, ?, ?)",
+                        [(user_id, ms, track_ids[index]) for ms, index in zip(played_at, indices) if index < len(track_ids)]
+                    )
+                    migrated += 1
+
+        try:
+            os.rename(legacy_dir, f"{legacy_dir}.migrated")
+        except FileNotFoundError:
+            return # migrated by another process meanwhile, the inserts above were idempotent
+        logger.info("Migrated the history of %d users from %s/ into %s", migrated, legacy_dir, self.path)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+async def ingest_recent(client: SpotifyClient, store: "PlayHistory") -> int:
+    """Poll a user's recently played tracks after their last stored play and append the new ones"""
+
+    user_id = client.auth_manager.user_id
+    since = time.time()
+    last = await asyncio.to_thread(store.last_played, user_id)
+
+    data = await client.current_user_recently_played(limit=50, after=last)
+    appended = await asyncio.to_thread(store.append, user_id, data["items"], since)
+
+    if appended:
+        logger.debug("%s: Ingested %d new plays", user_id, appended)
+
+    return appended
+
+class HistoryIngester():
+    """Background task polling every linked user's recently played tracks"""
+
+    def __init__(self,
+                 create_auth_manager: Callable,
+                 store: PlayHistory,
+                 tokens: TokenStore = token_store,
+                 interval: float = 20 * 60,
+                 concurrency: int = 4):
+        """
+        Create a history ingester
+
+        Attributes
+        ---
+        create_auth_manager: :class:`Callable`
+            builds the :class:`SpotifyAppOAuth` of a Discord user id
+        store: :class:`PlayHistory`
+            store receiving the new plays
+        tokens: :class:`TokenStore`
+            store listing every linked user
+        interval: :class:`float`
+            seconds between two polls of the same user, Spotify only returns the last 50 plays
+        concurrency: :class:`int`
+            maximum number of users polled at once
+        """
+
+        self.create_auth_manager = create_auth_manager
+        self.store = store
+        self.tokens = tokens
+        self.interval = interval
+        self.concurrency = concurrency
+        self._inflight = SingleFlight(timeout=60)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self.__run(), name="HistoryIngester")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def ingest(self, user_id: int) -> int:
+        """Ingest one user's new plays, coalescing concurrent calls for the same user"""
+
+        client = SpotifyClient(self.create_auth_manager(user_id))
+        return await self._inflight.do(user_id, lambda: ingest_recent(client, self.store))
+
+    async def __run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def ingest(user_id: int):
+            async with semaphore:
+                try:
+                    await self.ingest(user_id)
+                except Exception as e:
+                    logger.warning("%s: Unable to ingest recently played tracks: %s", user_id, e)
+
+        while True:
+            await asyncio.gather(*(ingest(user_id) for user_id in self.tokens.user_ids()))
+            await asyncio.sleep(self.interval)
+
+play_history = PlayHistory()
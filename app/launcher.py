@@ -0,0 +1,179 @@
+import os
+import time
+import asyncio
+import aiohttp
+import multiprocessing
+
+from app.loggerFyTops import logger, log_writer
+
+DISCORD_GATEWAY_BOT = "https://discord.com/api/v10/gateway/bot"
+
+def shard_ranges(shard_count: int, workers: int) -> list:
+    """Split shards ``0 .. shard_count-1`` into ``workers`` contiguous, balanced ranges"""
+
+    workers = max(1, min(workers, shard_count))
+    size, extra = divmod(shard_count, workers)
+
+    ranges, start = [], 0
+    for index in range(workers):
+        stop = start + size + (index < extra)
+        ranges.append(list(range(start, stop)))
+        start = stop
+    return ranges
+
+async def recommended_shard_count(bot_token: str) -> int:
+    """Ask Discord how many shards the bot should run"""
+
+    headers = {"Authorization": f"Bot {bot_token}"}
+    async with aiohttp.ClientSession() as session:
+        async with session.get(DISCORD_GATEWAY_BOT, headers=headers) as response:
+            response.raise_for_status()
+            return (await response.json())["shards"]
+
+def migrate_stores(close: bool = False):
+    """
+    Import the files of earlier versions into the SQLite stores, once before the bot starts
+
+    Attributes
+    ---
+    close: :class:`bool`
+        close the stores afterwards, for a process that does not run the bot itself
+    """
+
+    from app.tokenstore import token_store
+    from app.sharedcache import shared_cache
+    from app.colorengine import color_engine
+    from app.history import play_history
+
+    token_store.migrate()
+    color_engine.migrate()
+    play_history.migrate()
+
+    if close:
+        token_store.close()
+        shared_cache.close()
+        play_history.close()
+
+def run_worker(index: int, shard_ids: list, shard_count: int, settings: dict):
+    """Entry point of a worker process running a range of shards"""
+
+    # Each worker rotates its own log file, the writer opens it on the first record
+    root, ext = os.path.splitext(log_writer.path)
+    log_writer.path = f"{root}.worker{index}{ext}"
+
+    from app.startup import startup
+    from app.fytops import FyTops
+    from app.colorengine import color_engine
+    startup.mark("imports")
+
+    # Workers share the machine's cores for color extraction
+    color_engine.max_workers = settings["color_workers"]
+
+    bot = FyTops(
+        settings["client_id"],
+        settings["client_secret"],
+        settings["redirect_uri"],
+        callback_host=settings["callback_host"],
+        callback_port=settings["callback_port"] + index,
+        shard_ids=shard_ids,
+        shard_count=shard_count,
+        primary=index == 0,
+        dev_guild_id=settings.get("dev_guild_id")
+    )
+    bot.run(settings["bot_token"])
+
+class Launcher():
+    """Run the bot's shards across several worker processes
+
+    Every worker gets a contiguous range of shards and its own event loop, they
+    share the token store and the shared cache through SQLite files. Worker 0 is
+    the primary one and serves the OAuth callback on ``callback_port``, worker
+    ``i`` serves its metrics on ``callback_port + i``. Crashed workers are restarted.
+    """
+
+    def __init__(self, settings: dict, workers: int, shard_count: int = None, max_backoff: float = 60):
+        """
+        Create a multi-process launcher
+
+        Attributes
+        ---
+        settings: :class:`dict`
+            ``bot_token``, ``client_id``, ``client_secret``, ``redirect_uri``,
+            ``callback_host``, ``callback_port`` and optionally ``dev_guild_id``
+        workers: :class:`int`
+            number of worker processes
+        shard_count: :class:`int`
+            total number of shards, Discord's recommendation if not supplied
+        max_backoff: :class:`float`
+            maximum number of seconds before restarting a crashed worker
+        """
+
+        self.settings = settings
+        self.workers = workers
+        self.shard_count = shard_count
+        self.max_backoff = max_backoff
+        self._context = multiprocessing.get_context("spawn") # never fork the parent's threads
+        self._processes = {}
+
+    def run(self):
+        shard_count = self.shard_count or asyncio.run(recommended_shard_count(self.settings["bot_token"]))
+        ranges = shard_ranges(shard_count, self.workers)
+
+        settings = {**self.settings, "color_workers": max(1, (os.cpu_count() or 1) // len(ranges))}
+        
+        # Before any worker opens the stores, so they never race over the legacy files
+        migrate_stores(close=True)
+        logger.info("Launching %d workers for %d shards", len(ranges), shard_count)
+
+        restarts = [0] * len(ranges)
+        restart_at = {}
+        try:
+            for index, shard_ids in enumerate(ranges):
+                self.__spawn(index, shard_ids, shard_count, settings)
+
+            while self._processes or restart_at:
+                time.sleep(1)
+
+                for index, process in list(self._processes.items()):
+                    if process.is_alive():
+                        continue
+
+                    del self._processes[index]
+                    if process.exitcode == 0:
+                        logger.info("Worker %s exited", index)
+                        continue
+
+                    backoff = min(self.max_backoff, 2 ** restarts[index])
+                    restarts[index] += 1
+                    restart_at[index] = time.monotonic() + backoff
+                    logger.error("Worker %s died with exit code %s, restarting in %ss", index, process.exitcode, backoff)
+
+                for index, at in list(restart_at.items()):
+                    if time.monotonic() >= at:
+                        del restart_at[index]
+                        self.__spawn(index, ranges[index], shard_count, settings)
+
+        except KeyboardInterrupt:
+            logger.info("Stopping workers")
+
+        finally:
+            self.__stop()
+
+    def __spawn(self, index: int, shard_ids: list, shard_count: int, settings: dict):
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, shard_ids, shard_count, settings),
+            name=f"FyTopsWorker-{index}"
+        )
+        process.start()
+        self._processes[index] = process
+        logger.info("Worker %s started with shards %s-%s (pid %s)", index, shard_ids[0], shard_ids[-1], process.pid)
+
+    def __stop(self, timeout: float = 15):
+        # Workers got the same SIGINT, give them time to close cleanly
+        deadline = time.monotonic() + timeout
+        for process in self._processes.values():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+        self._processes.clear()
@@ -0,0 +1,241 @@
+import asyncio
+from typing import Awaitable, Callable, Iterable
+
+from app.cache import TTLCache, StaleWhileRevalidateCache
+from app.spotifyapp import SpotifyApp
+from app.loggerFyTops import logger
+
+# Items of each member's list taken into account, the most Spotify returns at once
+MEMBER_LIMIT = 50
+
+class Leaderboard():
+    """Weighted ranking of the top artists or tracks of a guild's members
+
+    Each member adds ``1 / log2(rank + 1)`` to the score of every item of their
+    list, so first places weigh the most but the whole list counts. When a
+    member's list changes only their contribution is replaced, the others are
+    never recomputed.
+    """
+
+    def __init__(self, kind: str):
+        """
+        Create an empty leaderboard
+
+        Attributes
+        ---
+        kind: :class:`str`
+            ``"artists"`` or ``"tracks"``
+        """
+
+        self.kind = kind
+        self.members = set()
+        self._index = {} # item id -> position in the score arrays
+        self._items = [] # item summaries by position
+        self._scores = None
+        self._counts = None
+        self._contributions = {} # user id -> (item ids, positions, weights)
+
+    def update(self, user_id: int, data: dict):
+        """Replace a member's contribution with their latest top list response"""
+
+        import numpy as np # loaded on the first leaderboard rather than at startup
+
+        items = data["items"][:MEMBER_LIMIT]
+        ids = tuple(item["id"] for item in items)
+
+        previous = self._contributions.get(user_id)
+        if previous is not None and previous[0] == ids:
+            return
+
+        positions = np.fromiter((self.__position(item) for item in items), dtype=np.int64, count=len(items))
+        weights = 1 / np.log2(np.arange(2, len(items) + 2))
+        self.__grow()
+
+        if previous is not None:
+            self.__apply(previous, -1)
+        contribution = (ids, positions, weights)
+        self.__apply(contribution, 1)
+        self._contributions[user_id] = contribution
+
+    def remove(self, user_id: int):
+        previous = self._contributions.pop(user_id, None)
+        if previous is not None:
+            self.__apply(previous, -1)
+
+    def sync_members(self, members: Iterable[int]):
+        """Set the guild's linked members, dropping the contributions of those who left"""
+
+        members = set(members)
+        for user_id in self.members - members:
+            self.remove(user_id)
+        self.members = members
+
+    @property
+    def contributors(self) -> int:
+        return len(self._contributions)
+
+    def top(self, limit: int = 10) -> list:
+        """
+        Return the best ranked items
+
+        Returns
+        ---
+        :class:`list`
+            ``(item, score, members)`` tuples, ``item`` being a summary with ``name``,
+            ``url`` and for tracks ``artists``
+        """
+
+        if self._scores is None:
+            return []
+
+        import numpy as np
+
+        n = len(self._items)
+        order = np.argsort(-self._scores[:n], kind="stable")[:limit]
+        return [
+            (self._items[index], float(self._scores[index]), int(self._counts[index]))
+            for index in order if self._counts[index] > 0
+        ]
+
+    def __position(self, item: dict) -> int:
+        position = self._index.get(item["id"])
+        if position is None:
+            position = self._index[item["id"]] = len(self._items)
+            summary = {"name": item["name"], "url": item["external_urls"]["spotify"]}
+            if self.kind == "tracks":
+                summary["artists"] = [artist["name"] for artist in item["artists"]]
+            self._items.append(summary)
+        return position
+
+    def __grow(self):
+        import numpy as np
+
+        size = 64 if self._scores is None else len(self._scores)
+        if self._scores is not None and size >= len(self._items):
+            return
+        while size < len(self._items):
+            size *= 2
+
+        scores, counts = np.zeros(size), np.zeros(size, dtype=np.int64)
+        if self._scores is not None:
+            scores[:len(self._scores)] = self._scores
+            counts[:len(self._counts)] = self._counts
+        self._scores, self._counts = scores, counts
+
+    def __apply(self, contribution: tuple, sign: int):
+        import numpy as np
+
+        _, positions, weights = contribution
+        np.add.at(self._scores, positions, sign * weights)
+        np.add.at(self._counts, positions, sign)
+
+class LeaderboardEngine():
+    """Guild leaderboards fed by the members' cached top lists
+
+    A ``/server-top`` fans out to the members' lists with bounded concurrency,
+    through the shared response cache and without any profile or color work.
+    Every list stored in that cache afterwards, e.g. refreshed in the background
+    or fetched for another guild, updates the leaderboards the member is part of.
+    """
+
+    def __init__(self, responses: StaleWhileRevalidateCache, concurrency: int = 8, maxsize: int = 256, ttl: float = 3600, members_ttl: float = 600):
+        """
+        Create a leaderboard engine
+
+        Attributes
+        ---
+        responses: :class:`StaleWhileRevalidateCache`
+            response cache the members' top lists are read from and listened to
+        concurrency: :class:`int`
+            members' lists fetched at once by a single command
+        maxsize: :class:`int`
+            maximum number of leaderboards and member lists kept in memory
+        ttl: :class:`float`
+            number of seconds an unused leaderboard is kept
+        members_ttl: :class:`float`
+            number of seconds the linked members of a guild are remembered
+        """
+
+        self.concurrency = concurrency
+        self._boards = TTLCache(maxsize=maxsize, ttl=ttl, name="leaderboard")
+        self._members = TTLCache(maxsize=maxsize, ttl=members_ttl)
+        responses.subscribe(self.__on_response)
+
+    def board(self, guild_id: int, kind: str, time_range: str) -> Leaderboard:
+        key = (guild_id, kind, time_range)
+        board = self._boards.get(key)
+        if board is None:
+            board = Leaderboard(kind)
+            self._boards.set(key, board)
+        return board
+
+    async def linked_members(self, guild, candidates: Callable[[int], list]) -> list:
+        """
+        Return the ids of the guild members who linked a Spotify account
+
+        Attributes
+        ---
+        guild: :class:`discord.Guild`
+            guild to look members up in, by id so the members intent is not needed
+        candidates: :class:`Callable`
+            blocking function returning the linked users seen in a guild, checked
+            against its current members
+        """
+
+        members = self._members.get(guild.id)
+        if members is None:
+            linked = await asyncio.to_thread(candidates, guild.id)
+            members = []
+            for start in range(0, len(linked), 100): # at most 100 ids per gateway request
+                found = await guild.query_members(user_ids=linked[start:start + 100], limit=100, cache=False)
+                members.extend(member.id for member in found)
+            self._members.set(guild.id, members)
+        return members
+
+    async def refresh(self, board: Leaderboard, members: list, fetch: Callable[[int], Awaitable[dict]]) -> int:
+        """
+        Bring a leaderboard up to date with its members' lists
+
+        Attributes
+        ---
+        fetch: :class:`Callable`
+            coroutine function returning a member's top list response
+
+        Returns
+        ---
+        :class:`int`
+            number of members whose list could not be fetched
+        """
+
+        board.sync_members(members)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch_member(user_id: int) -> dict:
+            async with semaphore:
+                return await fetch(user_id)
+
+        results = await asyncio.gather(*(fetch_member(user_id) for user_id in members), return_exceptions=True)
+
+        failed = 0
+        for user_id, result in zip(members, results):
+            if isinstance(result, BaseException): # including a cancelled fetch
+                failed += 1
+                logger.debug("%s: Leaderboard skipped the member: %s", user_id, result)
+            else:
+                board.update(user_id, result)
+        return failed
+
+    def __on_response(self, key: tuple, value):
+        # Response cache keys are (user id, kind, time range, limit, offset)
+        if len(key) != 5 or key[1] not in ("artists", "tracks") or key[3:] != (MEMBER_LIMIT, 0):
+            return
+
+        user_id, kind, time_range = key[:3]
+        for (_, board_kind, board_range), board in self._boards.items():
+            if board_kind == kind and board_range == time_range and user_id in board.members:
+                try:
+                    board.update(user_id, value)
+                except Exception as e:
+                    logger.warning("%s: Unable to update a leaderboard: %s", user_id, e)
+
+leaderboards = LeaderboardEngine(SpotifyApp.response_cache)
@@ -1,4 +1,11 @@
+import os
+import sys
+import json
+import queue
+import atexit
 import logging
+import threading
+import logging.handlers
 
 class Color:
    PURPLE = '\033[95m'
@@ -12,11 +19,162 @@ class Color:
    UNDERLINE = '\033[4m'
    RESET = '\033[0m'
 
+# Overridable from the environment (or .env)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+LOG_FILE = os.getenv("LOG_FILE", "../fytops.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text") # "text" or "json" (JSON lines)
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", 5))
+
+class JsonLinesFormatter(logging.Formatter):
+    """Compact structured format, one JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "msg": record.getMessage(),
+            "file": record.pathname,
+            "line": record.lineno
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler leaving every bit of formatting to the writer thread
+
+    The default :class:`QueueHandler` merges the message and its arguments in the
+    logging thread, i.e. on the Discord event loop
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+class BatchingLogWriter():
+    """Background thread draining the log queue in batches
+
+    Records waiting in the queue are written to the log file with a single write
+    and flush, the file is rotated once it exceeds ``max_bytes``
+    """
+
+    def __init__(self,
+                 records: queue.SimpleQueue,
+                 path: str,
+                 file_formatter: logging.Formatter,
+                 console: logging.Handler = None,
+                 max_bytes: int = LOG_MAX_BYTES,
+                 backups: int = LOG_BACKUPS,
+                 batch_size: int = 256):
+        """
+        Create a log writer
+
+        Attributes
+        ---
+        records: :class:`queue.SimpleQueue`
+            queue filled by :class:`DeferredQueueHandler`
+        path: :class:`str`
+            log file, rotated to ``path.1`` ... ``path.<backups>``
+        file_formatter: :class:`logging.Formatter`
+            formatter of the log file lines
+        console: :class:`logging.Handler`
+            handler also receiving every record, filtered by its own level
+        max_bytes: :class:`int`
+            size after which the log file is rotated
+        backups: :class:`int`
+            number of rotated files kept
+        batch_size: :class:`int`
+            maximum number of records written at once
+        """
+
+        self.records = records
+        self.path = path
+        self.file_formatter = file_formatter
+        self.console = console
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch_size = batch_size
+        self._file = None
+        self._thread = threading.Thread(target=self.__run, name="FyTopsLogWriter", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Write every queued record, then stop the writer thread"""
+
+        if self._thread.is_alive():
+            self.records.put(None)
+            self._thread.join()
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __run(self):
+        while True:
+            batch = [self.records.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = None in batch
+            self.__write([record for record in batch if record is not None])
+            if stopping:
+                return
+
+    def __write(self, batch: list):
+        lines = []
+        for record in batch:
+            if self.console is not None and record.levelno >= self.console.level:
+                self.console.handle(record)
+            try:
+                lines.append(self.file_formatter.format(record) + "\n")
+            except Exception:
+                # Same as logging's own handlers: report the broken record and carry on
+                if self.console is not None:
+                    self.console.handleError(record)
+
+        if not lines:
+            return
+
+        try:
+            file = self.__open()
+            file.write("".join(lines))
+            file.flush()
+            if file.tell() >= self.max_bytes:
+                self.__rotate()
+        except OSError as e:
+            print(f"Unable to write log file {self.path}: {e}", file=sys.stderr)
+
+    def __open(self):
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        return self._file
+
+    def __rotate(self):
+        self._file.close()
+        self._file = None
+
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
 logger = logging.getLogger("loggerFyTops")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 
 console = logging.StreamHandler()
-file_handler = logging.FileHandler(filename="../fytops.log")
 
 console_formatter = logging.Formatter(
     fmt=f"{Color.YELLOW}%(asctime)s {Color.BOLD}{Color.CYAN}%(levelname)s{Color.RESET}\t%(message)s",
@@ -28,10 +186,16 @@ file_formatter = logging.Formatter(
     datefmt="%m-%d-%Y %H:%M:%S"
 )
 
+if LOG_FORMAT == "json":
+    file_formatter = JsonLinesFormatter()
+
 console.setLevel("INFO")
 console.setFormatter(console_formatter)
-file_handler.setFormatter(file_formatter)
 
-logger.addHandler(console)
-logger.addHandler(file_handler)
+# Logging calls only enqueue the record, the writer thread formats and writes it
+log_queue = queue.SimpleQueue()
+log_writer = BatchingLogWriter(log_queue, LOG_FILE, file_formatter, console)
+log_writer.start()
+atexit.register(log_writer.stop)
 
+logger.addHandler(DeferredQueueHandler(log_queue))
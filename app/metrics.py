@@ -0,0 +1,235 @@
+import time
+import bisect
+import threading
+from typing import Callable
+from contextlib import contextmanager
+
+class Counter():
+    """Monotonic counter with labels"""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        """
+        Create a counter
+
+        Attributes
+        ---
+        name: :class:`str`
+            Prometheus metric name
+        help: :class:`str`
+            description exported with the metric
+        labelnames: :class:`tuple`
+            names of the labels every sample must provide
+        """
+
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram():
+    """Cumulative histogram with labels, for latencies in seconds"""
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        """
+        Create a histogram
+
+        Attributes
+        ---
+        name: :class:`str`
+            Prometheus metric name
+        help: :class:`str`
+            description exported with the metric
+        labelnames: :class:`tuple`
+            names of the labels every sample must provide
+        buckets: :class:`tuple`
+            sorted upper bounds of the buckets, ``+Inf`` is added implicitly
+        """
+
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {} # labels -> [bucket counts..., +Inf count, count, sum]
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 3)
+            counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the ``with`` block, including when it raises"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, counts in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{self.name}_bucket{format_labels(self.labelnames + ('le',), key + (le,))} {cumulative}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {counts[-2]}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {counts[-1]}")
+        return lines
+
+class Gauge():
+    """Current value read from a callback when the metrics are rendered"""
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        """
+        Create a gauge
+
+        Attributes
+        ---
+        name: :class:`str`
+            Prometheus metric name
+        help: :class:`str`
+            description exported with the metric
+        read: :class:`Callable`
+            returns the current value
+        """
+
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class MetricsRegistry():
+    """In-process metrics exported in the Prometheus text format
+
+    Metrics are updated from the Discord event loop and rendered from the HTTP
+    server's thread, every update only holds a lock for a dictionary update
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> Gauge:
+        return self._metrics.setdefault(name, Gauge(name, help, read))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+command_stage_seconds = metrics.histogram(
+    "fytops_command_stage_seconds",
+    "Time spent in each stage of a slash command",
+    ("command", "stage")
+)
+commands_total = metrics.counter(
+    "fytops_commands_total",
+    "Slash commands handled, by outcome",
+    ("command", "outcome")
+)
+spotify_responses_total = metrics.counter(
+    "fytops_spotify_responses_total",
+    "Spotify Web API responses, by endpoint and HTTP status",
+    ("endpoint", "status")
+)
+spotify_retries_total = metrics.counter(
+    "fytops_spotify_retries_total",
+    "Spotify Web API requests retried after a 429",
+    ("endpoint",)
+)
+cache_requests_total = metrics.counter(
+    "fytops_cache_requests_total",
+    "Cache lookups, by cache and result (hit, stale, miss or degraded)",
+    ("cache", "result")
+)
+color_seconds = metrics.histogram(
+    "fytops_color_seconds",
+    "Time to resolve the dominant color of a profile picture"
+)
+embed_render_seconds = metrics.histogram(
+    "fytops_embed_render_seconds",
+    "Time to build the embed of one page",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+)
+circuit_transitions_total = metrics.counter(
+    "fytops_circuit_transitions_total",
+    "Circuit breaker state changes, by circuit and new state",
+    ("circuit", "state")
+)
+hedged_requests_total = metrics.counter(
+    "fytops_hedged_requests_total",
+    "Extra attempts started for slow idempotent requests",
+    ("target",)
+)
+admissions_total = metrics.counter(
+    "fytops_admissions_total",
+    "Slash commands admitted or shed by admission control, by outcome",
+    ("outcome",)
+)
+admission_wait_seconds = metrics.histogram(
+    "fytops_admission_wait_seconds",
+    "Time admitted commands waited for a slot",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0)
+)
+scheduler_granted_total = metrics.counter(
+    "fytops_scheduler_granted_total",
+    "Spotify requests released by the request scheduler"
+)
+scheduler_throttled_total = metrics.counter(
+    "fytops_scheduler_throttled_total",
+    "Pauses of every Spotify request after a 429"
+)
+scheduler_wait_seconds = metrics.histogram(
+    "fytops_scheduler_wait_seconds",
+    "Time Spotify requests waited for their turn in the request scheduler",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
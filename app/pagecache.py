@@ -0,0 +1,99 @@
+import asyncio
+import secrets
+from typing import Optional
+
+from app.cache import TTLCache
+from app.sharedcache import SharedCache, shared_cache
+from app.loggerFyTops import logger
+
+class PageCache():
+    """Rendered pages of paginated replies, shared by every worker process
+
+    A reply is identified by a short result key carried in the ``custom_id`` of its
+    navigation buttons, so any process (including one started after the reply was
+    sent) can serve a button click. Pages live in a bounded in-memory cache in
+    front of the shared cache, both expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, store: SharedCache = shared_cache, maxsize: int = 2048, ttl: float = 24 * 3600, purge_interval: float = 3600):
+        """
+        Create a page cache
+
+        Attributes
+        ---
+        store: :class:`SharedCache`
+            persistent cache behind the in-memory one, shared by every worker process
+        maxsize: :class:`int`
+            maximum number of pages and results kept in memory
+        ttl: :class:`float`
+            number of seconds a result can be navigated after it was sent
+        purge_interval: :class:`float`
+            number of seconds between two purges of the expired shared entries
+        """
+
+        self.store = store
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._pages = TTLCache(maxsize=maxsize, ttl=ttl, name="pages")
+        self._results = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def new_key() -> str:
+        return secrets.token_hex(6)
+
+    async def result(self, key: str) -> Optional[dict]:
+        """Return what is needed to rebuild a result's pages, ``None`` once it expired"""
+
+        result = self._results.get(key)
+        if result is None:
+            result = await asyncio.to_thread(self.store.get, "results", key)
+            if result is not None:
+                self._results.set(key, result)
+        return result
+
+    async def set_result(self, key: str, result: dict):
+        self._results.set(key, result)
+        await asyncio.to_thread(self.store.set, "results", key, result, ttl=self.ttl)
+
+    async def get(self, key: str, page: int) -> Optional[dict]:
+        """Return the embed dictionary of a rendered page"""
+
+        embed = self._pages.get((key, page))
+        if embed is None:
+            embed = await asyncio.to_thread(self.store.get, "pages", f"{key}:{page}")
+            if embed is not None:
+                self._pages.set((key, page), embed)
+        return embed
+
+    async def set(self, key: str, page: int, embed: dict):
+        await self.set_many(key, {page: embed})
+
+    async def set_many(self, key: str, embeds: dict):
+        """Store several pages of a result in a single transaction"""
+
+        for page, embed in embeds.items():
+            self._pages.set((key, page), embed)
+        items = {f"{key}:{page}": embed for page, embed in embeds.items()}
+        await asyncio.to_thread(self.store.set_many, "pages", items, ttl=self.ttl)
+
+    def start(self):
+        """Periodically drop the expired shared entries, from a single process"""
+
+        if self._task is None:
+            self._task = asyncio.create_task(self.__purge_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def __purge_loop(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.store.purge)
+            except Exception as e:
+                logger.warning("Unable to purge the shared cache: %s", e)
+            await asyncio.sleep(self.purge_interval)
+
+page_cache = PageCache()
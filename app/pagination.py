@@ -1,20 +1,39 @@
 import discord
-from typing import Callable, Optional
+from typing import Awaitable, Callable, Optional
 
-class Pagination(discord.ui.View):    
-    """Credit: https://stackoverflow.com/questions/76247812/how-to-create-pagination-embed-menu-in-discord-py"""
+from app.pagecache import page_cache
 
-    def __init__(self, interaction: discord.Interaction, get_page: Callable):
-        self.interaction = interaction
-        self.get_page = get_page
-        self.total_pages: Optional[int] = None
-        self.index = 1
-        super().__init__(timeout=100)
+class PageButton(discord.ui.DynamicItem[discord.ui.Button],
+                 template=r"fytops:page:(?P<key>[0-9a-f]+):(?P<owner>[0-9]+):(?P<action>first|prev|next|last):(?P<page>-?[0-9]+)"):
+    """Navigation button of a paginated reply
+
+    Its ``custom_id`` holds the result key, the command author and the target page,
+    so a click is served from the page cache by any process, even after a restart
+    """
+
+    EMOJIS = {"first": "⏮️", "prev": "◀️", "next": "▶️", "last": "⏭️"}
+
+    def __init__(self, key: str, owner: int, action: str, page: int, disabled: bool = False):
+        super().__init__(
+            discord.ui.Button(
+                emoji=self.EMOJIS[action],
+                style=discord.ButtonStyle.blurple,
+                custom_id=f"fytops:page:{key}:{owner}:{action}:{page}",
+                disabled=disabled
+            )
+        )
+        self.key = key
+        self.owner = owner
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match) -> "PageButton":
+        return cls(match["key"], int(match["owner"]), match["action"], int(match["page"]))
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         """Check if current interaction is from the original user"""
-        
-        if interaction.user == self.interaction.user:
+
+        if interaction.user.id == self.owner:
             return True
         else:
             emb = discord.Embed(
@@ -24,52 +43,100 @@ class Pagination(discord.ui.View):
             await interaction.response.send_message(embed=emb, ephemeral=True)
             return False
 
-    async def navigate(self):
+    async def callback(self, interaction: discord.Interaction):
+        result = await page_cache.result(self.key)
+        if result is None:
+            emb = discord.Embed(
+                description="This result has expired, run the command again to browse it.",
+                color=16711680
+            )
+            await interaction.response.edit_message(view=None)
+            await interaction.followup.send(embed=emb, ephemeral=True)
+            return
+
+        total_pages = result["total_pages"]
+        page = min(max(self.page, 1), total_pages)
+        view = Pagination.view(self.key, self.owner, page, total_pages)
+
+        embed = await page_cache.get(self.key, page)
+        if embed is not None:
+            await interaction.response.edit_message(embed=discord.Embed.from_dict(embed), view=view)
+            return
+
+        # The page was never rendered or left the cache, build it again from Spotify
+        await interaction.response.defer()
+        embed = await interaction.client.render_result_page(self.key, result, page)
+        await interaction.edit_original_response(embed=embed, view=view)
+
+class Pagination():
+    """Send a paginated reply whose navigation buttons are stateless :class:`PageButton`
+
+    Nothing is kept once the reply is sent, pages are read back from the page cache
+    """
+
+    def __init__(self, interaction: discord.Interaction, key: str, get_page: Callable):
+        self.interaction = interaction
+        self.key = key
+        self.get_page = get_page
+        self.total_pages: Optional[int] = None
+        self.index = 1
+
+    async def navigate(self, ready: Optional[Callable[[], Awaitable]] = None, on_first_page: Optional[Callable] = None):
+        """Show the first page, then attach the navigation buttons
+
+        Attributes
+        ---
+        ready: :class:`Callable`
+            coroutine function awaited after the first page is shown and before the
+            buttons are attached, e.g. waiting for the next pages still loading
+        on_first_page: :class:`Callable`
+            called as soon as the first page has been sent
+        """
+
+        owner = self.interaction.user.id
         emb, self.total_pages = await self.get_page(self.index)
-        if self.total_pages == 1:
-            await self.interaction.response.send_message(embed=emb)
-        elif self.total_pages > 1:
-            self.update_buttons()
-            await self.interaction.response.send_message(embed=emb, view=self)
+        if self.total_pages > 1 and ready is None:
+            await self.reply(self.interaction, embed=emb, view=self.view(self.key, owner, self.index, self.total_pages))
+        else:
+            await self.reply(self.interaction, embed=emb)
+
+        if on_first_page is not None:
+            on_first_page()
+
+        if ready is None:
+            return
+
+        await ready()
 
-    async def edit_page(self, interaction: discord.Interaction):
+        # The total may have shrunk while the next pages loaded
         emb, self.total_pages = await self.get_page(self.index)
-        self.update_buttons()
-        await interaction.response.edit_message(embed=emb, view=self)
-
-    def update_buttons(self):
-        """Disable certain buttons at endpoints"""
-        
-        self.children[0].disabled = self.index == 1
-        self.children[1].disabled = self.index == 1
-        self.children[2].disabled = self.index == self.total_pages
-        self.children[3].disabled = self.index == self.total_pages
-
-    @discord.ui.button(emoji="⏮️", style=discord.ButtonStyle.blurple)
-    async def start(self, interaction: discord.Interaction, button: discord.Button):
-        self.index = 1
-        await self.edit_page(interaction)
-
-    @discord.ui.button(emoji="◀️", style=discord.ButtonStyle.blurple)
-    async def previous(self, interaction: discord.Interaction, button: discord.Button):
-        self.index -= 1
-        await self.edit_page(interaction)
-
-    @discord.ui.button(emoji="▶️", style=discord.ButtonStyle.blurple)
-    async def next(self, interaction: discord.Interaction, button: discord.Button):
-        self.index += 1
-        await self.edit_page(interaction)
-       
-    @discord.ui.button(emoji="⏭️", style=discord.ButtonStyle.blurple)
-    async def end(self, interaction: discord.Interaction, button: discord.Button):
-        self.index = self.total_pages
-        await self.edit_page(interaction)
-
-    async def on_timeout(self):
-        """Remove buttons on timeout"""
-        message = await self.interaction.original_response()
-        await message.edit(view=None)
+        if self.total_pages > 1:
+            view = self.view(self.key, owner, self.index, self.total_pages)
+            await self.interaction.edit_original_response(embed=emb, view=view)
+
+    @staticmethod
+    async def reply(interaction: discord.Interaction, **kwargs):
+        """Send the response of an interaction, or replace its deferred "thinking" message"""
+
+        if interaction.response.is_done():
+            await interaction.edit_original_response(**kwargs)
+        else:
+            await interaction.response.send_message(**kwargs)
+
+    @staticmethod
+    def view(key: str, owner: int, page: int, total_pages: int) -> discord.ui.View:
+        """Lay out the navigation buttons of a page, disabling certain buttons at endpoints"""
+
+        view = discord.ui.View(timeout=None)
+        view.add_item(PageButton(key, owner, "first", 1, disabled=page == 1))
+        view.add_item(PageButton(key, owner, "prev", page - 1, disabled=page == 1))
+        view.add_item(PageButton(key, owner, "next", page + 1, disabled=page == total_pages))
+        view.add_item(PageButton(key, owner, "last", total_pages, disabled=page == total_pages))
+
+        # Clicks are dispatched to the registered PageButton, a finished view is not stored by the client
+        view.stop()
+        return view
 
     @staticmethod
     def compute_total_pages(total_results: int, results_per_page: int) -> int:
-        return ((total_results - 1) // results_per_page) + 1
\ No newline at end of file
+        return ((total_results - 1) // results_per_page) + 1
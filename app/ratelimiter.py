@@ -0,0 +1,123 @@
+import time
+import asyncio
+from collections import deque
+from typing import Hashable, Optional
+
+from app.loggerFyTops import logger
+from app.metrics import scheduler_granted_total, scheduler_throttled_total, scheduler_wait_seconds
+
+class RequestScheduler():
+    """Global rate-limit-aware scheduler for Spotify requests
+
+    Requests are released from a token bucket and served round-robin across
+    Discord users, so one heavy user cannot starve the others. A ``Retry-After``
+    received from Spotify pauses every user until it has elapsed.
+    """
+
+    def __init__(self, rate: float = 10, burst: int = 20):
+        """
+        Create a request scheduler
+
+        Attributes
+        ---
+        rate: :class:`float`
+            requests released per second on average
+        burst: :class:`int`
+            maximum number of requests released at once after an idle period
+        """
+
+        self.rate = rate
+        self.burst = burst
+
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+
+        self._queues = {}
+        self._rotation = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+        self.granted = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def acquire(self, user_id: Hashable):
+        """Wait until the scheduler allows ``user_id`` to send one request"""
+
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self.__dispatch(), name="RequestScheduler")
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+            self._rotation.append(user_id)
+
+        queue.append((future, time.monotonic()))
+        self._wakeup.set()
+        await future
+
+    def retry_after(self, seconds: float):
+        """Pause every request for ``seconds`` after Spotify answered 429"""
+
+        self.throttled += 1
+        scheduler_throttled_total.inc()
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        logger.warning("Spotify rate limit reached, pausing requests for %ss", seconds)
+
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth(),
+            "queued_users": len(self._queues),
+            "paused_for": max(0.0, self._paused_until - time.monotonic()),
+            "granted": self.granted,
+            "throttled": self.throttled,
+            "avg_wait": self.total_wait / self.granted if self.granted else 0.0,
+            "max_wait": self.max_wait
+        }
+
+    def __refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    async def __dispatch(self):
+        while True:
+            if not self._rotation:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            self.__refill(now)
+            delay = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            # Serve the next user in turn, then move them to the back of the line
+            user_id = self._rotation.popleft()
+            queue = self._queues[user_id]
+            future, enqueued_at = queue.popleft()
+            if queue:
+                self._rotation.append(user_id)
+            else:
+                del self._queues[user_id]
+
+            # Waiter gave up, e.g. the command timed out
+            if future.done():
+                continue
+
+            self._tokens -= 1
+            wait = now - enqueued_at
+            self.granted += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            scheduler_granted_total.inc()
+            scheduler_wait_seconds.observe(wait)
+            future.set_result(None)
@@ -0,0 +1,126 @@
+import time
+import asyncio
+from typing import Any, Awaitable, Callable
+
+from app.loggerFyTops import logger
+from app.metrics import circuit_transitions_total, hedged_requests_total
+
+class CircuitBreaker():
+    """Stop calling an unhealthy dependency for a while instead of piling up requests
+
+    After ``failure_threshold`` consecutive failures the circuit opens and callers
+    fail fast for ``recovery_timeout`` seconds. A single probe request is then let
+    through (half-open): its success closes the circuit, its failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30):
+        """
+        Create a circuit breaker
+
+        Attributes
+        ---
+        name: :class:`str`
+            dependency name, reported in logs and metrics
+        failure_threshold: :class:`int`
+            consecutive failures opening the circuit
+        recovery_timeout: :class:`float`
+            number of seconds the circuit stays open before a probe is allowed
+        """
+
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_at = 0.0
+
+    def allow(self) -> bool:
+        """Whether a request may be sent now"""
+
+        if self.state == self.CLOSED:
+            return True
+
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self._opened_at < self.recovery_timeout:
+                return False
+            self.__transition(self.HALF_OPEN)
+            self._probe_at = now
+            return True
+
+        # Half-open: one probe at a time, another one if it never reported back
+        if now - self._probe_at >= self.recovery_timeout:
+            self._probe_at = now
+            return True
+        return False
+
+    def record_success(self):
+        self._failures = 0
+        if self.state != self.CLOSED:
+            self.__transition(self.CLOSED)
+
+    def record_failure(self):
+        self._failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failures >= self.failure_threshold):
+            self._opened_at = time.monotonic()
+            self.__transition(self.OPEN)
+
+    def __transition(self, state: str):
+        logger.warning("Circuit %s: %s -> %s", self.name, self.state, state)
+        self.state = state
+        circuit_transitions_total.inc(circuit=self.name, state=state)
+
+async def hedged(fn: Callable[[], Awaitable[Any]], delay: float, attempts: int = 2, name: str = "request") -> Any:
+    """
+    Run ``fn``, starting another attempt whenever ``delay`` seconds pass without a result
+
+    Only for idempotent requests: the first attempt to succeed wins and the others
+    are cancelled. An attempt failing early starts the next one right away, the
+    last error is raised if every attempt fails.
+
+    Attributes
+    ---
+    fn: :class:`Callable`
+        coroutine function performing one attempt
+    delay: :class:`float`
+        seconds to wait for an attempt before hedging it
+    attempts: :class:`int`
+        maximum number of attempts in flight over the whole call
+    name: :class:`str`
+        request kind reported in the hedging metrics
+    """
+
+    pending = set()
+    started = 0
+    error = None
+
+    try:
+        while True:
+            if started < attempts:
+                if started > 0:
+                    hedged_requests_total.inc(target=name)
+                pending.add(asyncio.create_task(fn()))
+                started += 1
+
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=delay if started < attempts else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+
+            if not pending and started >= attempts:
+                raise error
+
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Any, Hashable
+
+from app.formatters import loads
+
+class SharedCache():
+    """Key-value cache in a SQLite file shared by every worker process
+
+    Used as the second level behind the in-memory caches, so a value computed by
+    one worker (e.g. a dominant color or a Spotify profile) is reused by the
+    others. Values must be JSON serializable.
+    """
+
+    def __init__(self, path: str = "cache/shared.db"):
+        """
+        Create a shared cache, its file is opened (or created) on first use
+
+        Attributes
+        ---
+        path: :class:`str`
+            SQLite database file, opened in WAL mode so readers never block writers
+        """
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None # opened on first use, importing the module creates no file
+
+    def __connection(self) -> sqlite3.Connection:
+        """Return the connection, opening the database first if needed (called under the lock)"""
+
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "namespace TEXT NOT NULL, "
+                "key TEXT NOT NULL, "
+                "value TEXT NOT NULL, "
+                "expires_at REAL, "
+                "PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+            )
+            self._conn = conn
+        return self._conn
+
+    def get(self, namespace: str, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            row = self.__connection().execute(
+                "SELECT value, expires_at FROM entries WHERE namespace = ? AND key = ?",
+                (namespace, str(key))
+            ).fetchone()
+
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return default
+        return loads(row[0])
+
+    def set(self, namespace: str, key: Hashable, value: Any, ttl: float = None):
+        self.set_many(namespace, {key: value}, ttl)
+
+    def set_many(self, namespace: str, items: dict, ttl: float = None):
+        """Write several entries of a namespace in a single transaction"""
+
+        expires_at = None if ttl is None else time.time() + ttl
+        rows = [(namespace, str(key), json.dumps(value), expires_at) for key, value in items.items()]
+
+        with self._lock:
+            conn = self.__connection()
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "INSERT INTO entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                    rows
+                )
+
+    def add(self, namespace: str, key: Hashable, value: Any, ttl: float = None) -> bool:
+        """Store an entry unless the key already holds one that has not expired, return whether it was stored"""
+
+        now = time.time()
+        expires_at = None if ttl is None else now + ttl
+
+        with self._lock:
+            cursor = self.__connection().execute(
+                "INSERT INTO entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+                "WHERE entries.expires_at IS NOT NULL AND entries.expires_at <= ?",
+                (namespace, str(key), json.dumps(value), expires_at, now)
+            )
+            return cursor.rowcount > 0
+
+    def delete(self, namespace: str, key: Hashable):
+        with self._lock:
+            self.__connection().execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, str(key)))
+
+    def purge(self):
+        """Drop every expired entry"""
+
+        with self._lock:
+            self.__connection().execute("DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+shared_cache = SharedCache()
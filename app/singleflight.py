@@ -0,0 +1,62 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+class SingleFlight():
+    """Coalesce concurrent identical calls into a single in-flight request
+
+    Callers asking for a key that is already being fetched await the same
+    future instead of issuing their own request, and receive its result or
+    its exception
+    """
+
+    def __init__(self, timeout: float = None):
+        """
+        Create a single-flight group
+
+        Attributes
+        ---
+        timeout: :class:`float`
+            default number of seconds a call may run before failing with :class:`asyncio.TimeoutError`
+        """
+
+        self.timeout = timeout
+        self._calls = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]], timeout: float = None) -> Any:
+        """
+        Run ``fn`` unless a call with the same ``key`` is already in flight
+
+        Attributes
+        ---
+        key: :class:`Hashable`
+            identifies identical calls
+        fn: :class:`Callable`
+            coroutine function performing the call
+        timeout: :class:`float`
+            seconds the shared call may run, overriding the group default
+        """
+
+        task = self._calls.get(key)
+        if task is None:
+            timeout = self.timeout if timeout is None else timeout
+            task = asyncio.create_task(self.__run(key, fn, timeout))
+            task.add_done_callback(self.__retrieve_exception)
+            self._calls[key] = task
+
+        # A cancelled waiter must not cancel the call shared with other waiters
+        return await asyncio.shield(task)
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def __run(self, key: Hashable, fn: Callable[[], Awaitable[Any]], timeout: float) -> Any:
+        try:
+            return await asyncio.wait_for(fn(), timeout)
+        finally:
+            self._calls.pop(key, None)
+
+    @staticmethod
+    def __retrieve_exception(task: asyncio.Task):
+        # Waiters may all be gone, mark the exception as retrieved anyway
+        if not task.cancelled():
+            task.exception()
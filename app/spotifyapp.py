@@ -1,167 +1,441 @@
-import requests
-from spotipy import Spotify 
-from spotipy.oauth2 import SpotifyOAuth
-
+import hmac
 import json
-import dateutil.parser as dp
-from datetime import datetime 
-from io import BytesIO
-from colorthief import ColorThief
+import time
+import base64
+import asyncio
+import hashlib
+import secrets
+from typing import Optional
+from urllib.parse import urlencode
 from discord import Color
 
-class SpotifyAppOAuth(SpotifyOAuth):
+from app.spotifyclient import SpotifyClient, SpotifyException, SpotifyOauthError, is_transient
+from app.cache import TTLCache, StaleWhileRevalidateCache
+from app.colorengine import color_engine, NULL_IMAGE, FALLBACK_COLOR
+from app.collage import card_renderer
+from app.tokenstore import token_store, TokenCacheHandler
+from app.sharedcache import shared_cache
+from app.history import play_history, ingest_recent
+from app.formatters import EmbedField, LazyFields, iso_to_unix
+from app.metrics import color_seconds
+from app.loggerFyTops import logger
+
+class SpotifyAppOAuth():
+    """Spotify authorization code flow of one Discord user
+
+    Follows spotipy's ``SpotifyOAuth`` interface for the parts the bot uses, without
+    importing spotipy (and its requests and redis dependencies) at startup
+    """
+
+    OAUTH_AUTHORIZE_URL = "https://accounts.spotify.com/authorize"
+    OAUTH_TOKEN_URL = "https://accounts.spotify.com/api/token"
+
+    # Seconds a login link can be completed after it was issued
+    STATE_TTL = 600
+
     def __init__(self, user_id: int, client_id, client_secret, redirect_uri):
-        cache_path = self.get_user_cache_path(user_id)
+        self.user_id = user_id
         
         scopes = [
             "user-top-read",
             "user-read-recently-played"
             ]
         
-        super().__init__(
-            client_id=client_id,
-            client_secret=client_secret,
-            redirect_uri=redirect_uri,
-            scope=scopes,
-            cache_path=cache_path,
-        )
-        
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+        self.scope = " ".join(sorted(scopes))
+        self.cache_handler = TokenCacheHandler(user_id, token_store)
+
+    def get_authorize_url(self, state: str = None) -> str:
+        payload = {
+            "client_id": self.client_id,
+            "response_type": "code",
+            "redirect_uri": self.redirect_uri,
+            "scope": self.scope,
+            "state": state or self.sign_state(self.user_id, self.client_secret)
+        }
+        return f"{self.OAUTH_AUTHORIZE_URL}?{urlencode(payload)}"
+
     @staticmethod
-    def get_user_cache_path(user_id):
-        return f"user_tokens/{user_id}.cache"
-        
-class SpotifyApp(Spotify):
+    def is_token_expired(token_info: dict) -> bool:
+        return token_info["expires_at"] - int(time.time()) < 60
+
+    @staticmethod
+    def _is_scope_subset(needle_scope: str, haystack_scope: str) -> bool:
+        needle_scope = set(needle_scope.split()) if needle_scope else set()
+        haystack_scope = set(haystack_scope.split()) if haystack_scope else set()
+        return needle_scope <= haystack_scope
+
+    def _make_authorization_headers(self) -> dict:
+        credentials = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode()
+        return {"Authorization": f"Basic {credentials}"}
+
+    def _add_custom_values_to_token_info(self, token_info: dict) -> dict:
+        token_info["expires_at"] = int(time.time()) + token_info["expires_in"]
+        token_info["scope"] = self.scope
+        return token_info
+
+    @staticmethod
+    def sign_state(user_id: int, client_secret: str, issued_at: int = None, nonce: str = None) -> str:
+        """Return a new OAuth ``state`` identifying a Discord user in the authorization redirect
+
+        The signed payload holds the issue time and a random nonce, so a login link
+        expires and can only be completed once
+        """
+
+        issued_at = int(time.time()) if issued_at is None else issued_at
+        nonce = secrets.token_hex(8) if nonce is None else nonce
+        payload = f"{user_id}.{issued_at}.{nonce}"
+
+        signature = hmac.new(str(client_secret).encode(), payload.encode(), hashlib.sha256).hexdigest()
+        return f"{payload}.{signature[:32]}"
+
+    @classmethod
+    def verify_state(cls, state: str, client_secret: str) -> Optional[tuple]:
+        """
+        Check a ``state`` signed by :meth:`sign_state`
+
+        Returns
+        ---
+        :class:`tuple`
+            the Discord user id and the nonce to consume, ``None`` if forged or expired
+        """
+
+        parts = (state or "").split(".")
+        if len(parts) != 4 or not parts[0].isdigit() or not parts[1].isdigit():
+            return None
+
+        user_id, issued_at, nonce = int(parts[0]), int(parts[1]), parts[2]
+        if not hmac.compare_digest(state, cls.sign_state(user_id, client_secret, issued_at, nonce)):
+            return None
+        if not 0 <= time.time() - issued_at <= cls.STATE_TTL:
+            return None
+        return user_id, nonce
+
+    async def get_access_token_async(self, code=None) -> str:
+        """
+        Asynchronous counterpart of spotipy's ``SpotifyOAuth.get_access_token``
+
+        Exchange ``code`` for a new token if supplied, otherwise return the cached
+        access token (refreshed if expired). Raises :class:`SpotifyOauthError`
+        if the user has no valid token.
+        """
+
+        if code is None:
+            token_info = await self.validate_token_async(self.cache_handler.get_cached_token())
+            if token_info is None:
+                raise SpotifyOauthError("No cached access token", error="invalid_token")
+            return token_info["access_token"]
+
+        payload = {
+            "redirect_uri": self.redirect_uri,
+            "code": code,
+            "grant_type": "authorization_code",
+        }
+        if self.scope:
+            payload["scope"] = self.scope
+
+        token_info = await self.__request_token(payload)
+        self.cache_handler.save_token_to_cache(token_info)
+        return token_info["access_token"]
+
+    async def validate_token_async(self, token_info):
+        if token_info is None:
+            return None
+
+        if "scope" not in token_info or not self._is_scope_subset(self.scope, token_info["scope"]):
+            return None
+
+        if self.is_token_expired(token_info):
+            token_info = await self.refresh_access_token_async(token_info["refresh_token"])
+
+        return token_info
+
+    async def refresh_access_token_async(self, refresh_token):
+        payload = {
+            "refresh_token": refresh_token,
+            "grant_type": "refresh_token",
+        }
+
+        token_info = await self.__request_token(payload)
+        if "refresh_token" not in token_info:
+            token_info["refresh_token"] = refresh_token
+
+        # A logout or new login during the request wins, the current token is returned instead
+        if not self.cache_handler.replace_cached_token(refresh_token, token_info):
+            return self.cache_handler.get_cached_token()
+        return token_info
+
+    async def __request_token(self, payload: dict) -> dict:
+        """POST to the Spotify token endpoint through the shared HTTP session"""
+
+        headers = self._make_authorization_headers()
+
+        await SpotifyClient.scheduler.acquire(self.user_id)
+        async with SpotifyClient.session().post(self.OAUTH_TOKEN_URL, data=payload, headers=headers, timeout=SpotifyClient.timeout("token")) as response:
+            # An outage or rate limit of the accounts service must not look like a revoked token
+            if response.status >= 500 or response.status == 429:
+                if response.status == 429:
+                    SpotifyClient.scheduler.retry_after(float(response.headers.get("Retry-After", 1)))
+                raise SpotifyException(response.status, -1, f"{self.OAUTH_TOKEN_URL}: {response.reason}", headers=dict(response.headers))
+            
+            if response.status >= 400:
+                try:
+                    error_payload = await response.json(content_type=None)
+                    error = error_payload.get("error")
+                    error_description = error_payload.get("error_description")
+                except ValueError:
+                    error = await response.text() or None
+                    error_description = None
+
+                raise SpotifyOauthError(
+                    f"error: {error}, error_description: {error_description}",
+                    error=error,
+                    error_description=error_description
+                )
+
+            token_info = await response.json(content_type=None)
+
+        return self._add_custom_values_to_token_info(token_info)
+
+class SpotifyApp(SpotifyClient):
+    # Spotify profiles shared by every SpotifyApp, keyed by Discord user id
+    profile_cache = TTLCache(maxsize=2048, ttl=600, name="profile")
+
+    # Spotify responses shared by every SpotifyApp, (fresh, stale) lifetimes in seconds per kind
+    response_cache = StaleWhileRevalidateCache(
+        ttls={
+            "artists": (3600, 6 * 3600),
+            "tracks": (3600, 6 * 3600),
+            "recent": (30, 300)
+        },
+        maxsize=4096,
+        degrade_on=is_transient
+    )
+
     def __init__(self, auth_manager):
         super().__init__(auth_manager=auth_manager)
         self.user_info = {}
-        self.__set_spotify_user_info()
 
-    def __set_spotify_user_info(self):
-        user = self.me()
-        
-        # Compute embed description
-        username = user["display_name"]
-        user_url = user["external_urls"]["spotify"]
-        now = datetime.now().isoformat()
-        now = self.iso_to_unix(now)
-        description = f"[{username}]({user_url}) on Spotify\nData generated on <t:{now}:f>\n\u200b"
+    @classmethod
+    async def create(cls, auth_manager):
+        """Create a Spotify app and load the current user's profile"""
+
+        object = cls(auth_manager)
+        await object.load_user_info()
+        return object
+
+    @classmethod
+    async def invalidate_user(cls, user_id: int):
+        """Drop the cached Spotify profile, responses and cards of a Discord user"""
+        cls.profile_cache.pop(user_id)
+        cls.response_cache.invalidate_user(user_id)
+        await asyncio.to_thread(shared_cache.delete, "profile", user_id)
+        await asyncio.to_thread(card_renderer.invalidate_user, user_id)
+
+    async def get_profile(self) -> dict:
+        """Return the current user's Spotify profile, using the shared profile caches when possible"""
+
+        user_id = self.auth_manager.user_id
+        profile = self.profile_cache.get(user_id)
+        if profile is not None:
+            return profile
+
+        # Another worker process may have built it already
+        stored = await asyncio.to_thread(shared_cache.get, "profile", user_id)
+        ttl = self.profile_cache.ttl
+        if stored is None:
+            stored = await self.__build_profile()
+            
+            # Built with the default color, try again soon
+            if stored.pop("degraded", False):
+                ttl = 60
+            await asyncio.to_thread(shared_cache.set, "profile", user_id, stored, ttl=ttl)
+
+        profile = {**stored, "color": Color.from_rgb(*stored["color"])}
+        self.profile_cache.set(user_id, profile, ttl=ttl)
+        return profile
+
+    async def __build_profile(self) -> dict:
+        user = await self.me()
 
         # Get user profile picture
-        null_image = "https://media.discordapp.net/attachments/1374160501877248113/1377302749628076062/null_avatar.png?ex=683878a4&is=68372724&hm=91a9d8e64bcdd49ae6a57b5684bd8ea47c84d910b5e961ba08a6c6eecd7b80f7&=&format=webp&quality=lossless&width=1260&height=1260"
-        user_image = null_image if not user["images"] else user["images"][0]["url"]
+        user_image = NULL_IMAGE if not user["images"] else user["images"][0]["url"]
         
-        # Get dominant color in user profile picture
-        response = requests.get(user_image)
-        response.raise_for_status()
+        # Get dominant color in user profile picture, the color is cosmetic so any failure
+        # (CDN down, missing or undecodable image) falls back to the default one
+        degraded = False
+        with color_seconds.time():
+            try:
+                rgb = await color_engine.get_color(user_image, self.get_bytes)
+            except Exception as e:
+                logger.warning("%s: Using the default color, unable to extract it from %s: %s", self.auth_manager.user_id, user_image, e)
+                rgb, degraded = FALLBACK_COLOR, True
         
-        image = BytesIO(response.content)
-        
-        color_thief = ColorThief(image)
-        r, g, b = color_thief.get_color(quality=5)
+        return {
+            "display_name": user["display_name"],
+            "url": user["external_urls"]["spotify"],
+            "image": user_image,
+            "color": list(rgb),
+            "degraded": degraded
+        }
+
+    async def load_user_info(self):
+        """Load the current user's profile into the embed attributes shared by every reply"""
+
+        profile = await self.get_profile()
         
+        # Compute embed description
+        username = profile["display_name"]
+        user_url = profile["url"]
+        now = round(time.time())
+        description = f"[{username}]({user_url}) on Spotify\nData generated on <t:{now}:f>\n\u200b"
+
         # Compute user attributes and update
         attributes = {
             "description": description, 
-            "thumbnail": user_image, 
-            "color": Color.from_rgb(r, g, b)
+            "thumbnail": profile["image"], 
+            "color": profile["color"]
         }
         
         self.user_info.update(attributes)
 
-    def format_top_artists(self, limit=20, offset=0, time_range="medium_term"):
+    async def format_top_artists(self, limit=20, offset=0, time_range="medium_term"):
         time_range = self.alias_time_range(time_range)
         
-        # Set embed attributes
-        artists = {
-            "title": self.time_range_definition("Top Artists", time_range),
-            "fields": []
-        }   
-        
         # Request data using API call
-        data = self.current_user_top_artists(limit=limit, offset=offset, time_range=time_range)
+        data = await self.response_cache.get(
+            (self.auth_manager.user_id, "artists", time_range, limit, offset),
+            "artists",
+            lambda: self.current_user_top_artists(limit=limit, offset=offset, time_range=time_range)
+        )
 
-        # Reformat the raw data
-        for rank, item in enumerate(data["items"], 1):
-            name = item["name"]
-            url = item["external_urls"]["spotify"]
-            followers = item["followers"]["total"]
-            
-            # Format individual fields
-            field = {
-                "name": f"{self.rank_emojify(rank)} {name}",
-                "value": f"[Artist on Spotify]({url}) with {followers:,} followers",
-                "inline": False
-            }      
-
-            artists["fields"].append(field)
-            
-        return self.user_info | artists
+        # Set embed attributes, fields are formatted when their page is displayed
+        return {
+            **self.user_info,
+            "title": self.time_range_definition("Top Artists", time_range),
+            "fields": LazyFields(data["items"], self.artist_field, start=offset + 1),
+            "total": data["total"]
+        }
     
-    def format_top_tracks(self, limit=20, offset=0, time_range="medium_term"):
+    async def format_top_tracks(self, limit=20, offset=0, time_range="medium_term"):
         time_range=self.alias_time_range(time_range)
         
-        # Set embed attributes
-        tracks = {
-            "title": self.time_range_definition("Top Tracks", time_range),
-            "fields": []
-        }   
-     
         # Request data using API call
-        data = self.current_user_top_tracks(limit=limit, offset=offset, time_range=time_range)
+        data = await self.response_cache.get(
+            (self.auth_manager.user_id, "tracks", time_range, limit, offset),
+            "tracks",
+            lambda: self.current_user_top_tracks(limit=limit, offset=offset, time_range=time_range)
+        )
         
-        # Reformat the raw data
-        for rank, item in enumerate(data["items"], 1):
-            album_name = item["album"]["name"]
-            album_url = item["external_urls"]["spotify"]
-            
-            artists = ", ".join([artist["name"] for artist in item["artists"]])
-            
-            song_name = item["name"]
-            song_url = item["external_urls"]["spotify"]
-            
-            # Format individual fields
-            field = {
-                "name": f"{self.rank_emojify(rank)} {song_name} - {artists}",
-                "value": f"[Track on Spotify]({song_url}) from album [{album_name}]({album_url})",
-                "inline": False
-            }
-            
-            tracks["fields"].append(field)
-
-        return self.user_info | tracks
+        # Set embed attributes, fields are formatted when their page is displayed
+        return {
+            **self.user_info,
+            "title": self.time_range_definition("Top Tracks", time_range),
+            "fields": LazyFields(data["items"], self.track_field, start=offset + 1),
+            "total": data["total"]
+        }
     
-    def format_recent(self, limit=20):
-        EMOJI = ":musical_notes:"
+    async def format_recent(self, limit=20, offset=0, before=None):
+        # Append plays newer than the local history (at most once per cache lifetime), then read locally
+        user_id = self.auth_manager.user_id
+        await self.response_cache.get(
+            (user_id, "recent"),
+            "recent",
+            lambda: ingest_recent(self, play_history)
+        )
+        
+        # Pages of a reply are read up to its newest play, plays appended later do not shift them
+        if before is None:
+            before = await asyncio.to_thread(play_history.last_played, user_id)
+        plays = await asyncio.to_thread(play_history.recent, user_id, limit, offset, before)
         
-        # Set embed attributes
-        recent = { 
+        # Set embed attributes, fields are formatted when their page is displayed
+        return {
+            **self.user_info,
             "title": self.time_range_definition("Recently played Tracks"),
-            "fields": []
-        }   
+            "fields": LazyFields(plays, self.play_field, start=offset + 1),
+            "before": before
+        }
+    
+    async def top_items(self, kind: str, time_range: str, limit: int = 50, offset: int = 0) -> dict:
+        """Return the user's top ``"artists"`` or ``"tracks"`` response, through the shared response cache
+        
+        Callers must not modify the returned data
+        """
+        
+        fetch = self.current_user_top_artists if kind == "artists" else self.current_user_top_tracks
+        
+        # Same entries as the text lists of the same size
+        return await self.response_cache.get(
+            (self.auth_manager.user_id, kind, time_range, limit, offset),
+            kind,
+            lambda: fetch(limit=limit, offset=offset, time_range=time_range)
+        )
 
-        # Request data using API call
-        data = self.current_user_recently_played(limit=limit)
+    async def format_card(self, kind="tracks", time_range="medium_term", grid=3):
+        """Return the embed attributes of a collage card and the artwork URLs of its tiles"""
+
+        time_range = self.alias_time_range(time_range)
+        items = (await self.top_items(kind, time_range, limit=grid * grid))["items"]
+        images = [item["images"] for item in items] if kind == "artists" else [item["album"]["images"] for item in items]
         
-        # Reformat the raw data
-        for item in data["items"]:
-            song_name = item["track"]["name"]
-            song_url = item["track"]["external_urls"]["spotify"]
-            
-            iso_time = item["played_at"]
-            unix_time = self.iso_to_unix(iso_time)
-            
-            artists = ", ".join([artist["name"] for artist in item["track"]["artists"]])
-
-            # Format individual fields
-            field = {
-                "name": f"{EMOJI} {song_name} - {artists}",
-                "value": f"[Track on Spotify]({song_url})\nPlayed <t:{unix_time}:R> (<t:{unix_time}:f>)",
-                "inline": False
-            }
-            
-            recent["fields"].append(field)
+        return {
+            **self.user_info,
+            "title": self.time_range_definition(f"Top {kind.capitalize()}", time_range),
+            "urls": [self.artwork_url(choices, 900 // grid) for choices in images]
+        }
+
+    @staticmethod
+    def artwork_url(images: list, size: int):
+        """Return the smallest image at least ``size`` pixels wide, the largest one otherwise"""
+
+        if not images:
+            return None
+        
+        large_enough = [image for image in images if (image.get("width") or 0) >= size]
+        if large_enough:
+            return min(large_enough, key=lambda image: image["width"])["url"]
+        return max(images, key=lambda image: image.get("width") or 0)["url"]
+
+    @classmethod
+    def artist_field(cls, rank: int, item: dict) -> EmbedField:
+        name = item["name"]
+        url = item["external_urls"]["spotify"]
+        followers = item["followers"]["total"]
+        
+        return EmbedField(
+            name=f"{cls.rank_emojify(rank)} {name}",
+            value=f"[Artist on Spotify]({url}) with {followers:,} followers"
+        )
+    
+    @classmethod
+    def track_field(cls, rank: int, item: dict) -> EmbedField:
+        album_name = item["album"]["name"]
+        album_url = item["external_urls"]["spotify"]
+        
+        artists = ", ".join([artist["name"] for artist in item["artists"]])
+        
+        song_name = item["name"]
+        song_url = item["external_urls"]["spotify"]
         
-        return self.user_info | recent
+        return EmbedField(
+            name=f"{cls.rank_emojify(rank)} {song_name} - {artists}",
+            value=f"[Track on Spotify]({song_url}) from album [{album_name}]({album_url})"
+        )
+    
+    @staticmethod
+    def play_field(position: int, play: tuple) -> EmbedField:
+        EMOJI = ":musical_notes:"
+        
+        unix_time, track = play
+        artists = ", ".join(track["artists"])
+        
+        return EmbedField(
+            name=f"{EMOJI} {track['name']} - {artists}",
+            value=f"[Track on Spotify]({track['url']})\nPlayed <t:{unix_time}:R> (<t:{unix_time}:f>)"
+        )
     
     @staticmethod
     def rank_emojify(rank: int):
@@ -202,7 +476,7 @@ class SpotifyApp(Spotify):
     
     @staticmethod
     def iso_to_unix(time):
-        return round(dp.parse(time).timestamp())
+        return iso_to_unix(time)
     
     @staticmethod
     def dict_to_json(data, filename):
@@ -0,0 +1,237 @@
+import asyncio
+import aiohttp
+from typing import Optional
+
+from app.singleflight import SingleFlight
+from app.formatters import loads
+from app.ratelimiter import RequestScheduler
+from app.resilience import CircuitBreaker, hedged
+from app.metrics import metrics, spotify_responses_total, spotify_retries_total
+
+class SpotifyException(Exception):
+    """Error response of the Spotify Web API, same attributes as spotipy's"""
+
+    def __init__(self, http_status: int, code: int, msg: str, reason: str = None, headers: dict = None):
+        self.http_status = http_status
+        self.code = code
+        self.msg = msg
+        self.reason = reason
+        self.headers = headers or {}
+
+    def __str__(self) -> str:
+        return f"http status: {self.http_status}, code: {self.code} - {self.msg}, reason: {self.reason}"
+
+class SpotifyOauthError(Exception):
+    """Error response of the Spotify accounts service, same attributes as spotipy's"""
+
+    def __init__(self, message: str, error: str = None, error_description: str = None):
+        self.error = error
+        self.error_description = error_description
+        super().__init__(message)
+
+class SpotifyUnavailable(SpotifyException):
+    """Raised without sending anything while the circuit of a Spotify host is open"""
+
+    def __init__(self, circuit: str):
+        super().__init__(503, -1, f"{circuit} is unavailable, not sending the request")
+
+def is_transient(error: BaseException) -> bool:
+    """Whether an error comes from Spotify being slow or unhealthy rather than from the request itself"""
+
+    if isinstance(error, SpotifyException):
+        return error.http_status >= 500 or error.http_status == 429
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError))
+
+def is_revoked(error: SpotifyOauthError) -> bool:
+    """Whether the user's token is gone for good, as opposed to the accounts service failing the request"""
+
+    return error.error in ("invalid_grant", "invalid_token")
+
+class SpotifyClient():
+    """Asynchronous Spotify Web API client
+
+    Every instance shares a single pooled keep-alive HTTP connector, so requests
+    from many users can be in flight at once on the Discord event loop
+    """
+
+    API_PREFIX = "https://api.spotify.com/v1/"
+
+    _session: Optional[aiohttp.ClientSession] = None
+
+    # Identical concurrent requests share a single in-flight call
+    inflight = SingleFlight(timeout=15)
+
+    # Every Spotify request waits for its turn in this scheduler
+    scheduler = RequestScheduler(rate=10, burst=20)
+    max_retries = 3
+
+    # Seconds a single HTTP attempt may take, per endpoint
+    timeouts = {
+        "me/": 4,
+        "me/top/artists": 6,
+        "me/top/tracks": 6,
+        "me/player/recently-played": 6,
+        "token": 8
+    }
+    default_timeout = 6
+
+    # Images are small and served by a CDN, a slow download is hedged rather than awaited
+    image_timeout = 4
+    image_hedge_delay = 0.5
+
+    # Fail fast while the Web API or the image CDN is unhealthy
+    api_circuit = CircuitBreaker("spotify_api", failure_threshold=5, recovery_timeout=30)
+    image_circuit = CircuitBreaker("spotify_images", failure_threshold=10, recovery_timeout=30)
+
+    def __init__(self, auth_manager):
+        """
+        Create an asynchronous Spotify client
+
+        Attributes
+        ---
+        auth_manager:
+            :class:`SpotifyAppOAuth` providing the user's access token
+        """
+
+        self.auth_manager = auth_manager
+
+    @classmethod
+    def session(cls) -> aiohttp.ClientSession:
+        """Return the shared HTTP session, creating it on first use inside the running loop"""
+
+        # Stored on SpotifyClient itself so that subclasses share the same session
+        if SpotifyClient._session is None or SpotifyClient._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=50,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            SpotifyClient._session = aiohttp.ClientSession(connector=connector)
+
+        return SpotifyClient._session
+
+    @classmethod
+    def timeout(cls, endpoint: str) -> aiohttp.ClientTimeout:
+        return aiohttp.ClientTimeout(total=cls.timeouts.get(endpoint, cls.default_timeout))
+
+    @classmethod
+    async def close_session(cls):
+        if SpotifyClient._session is not None and not SpotifyClient._session.closed:
+            await SpotifyClient._session.close()
+        SpotifyClient._session = None
+
+    async def _get(self, endpoint: str, **params) -> dict:
+        """Send an authorized GET request to a Spotify Web API endpoint
+        
+        Concurrent identical requests of the same user are coalesced, callers must
+        not modify the returned data
+        """
+
+        # aiohttp only accepts string query values
+        params = {key: str(value) for key, value in params.items() if value is not None}
+        key = (self.auth_manager.user_id, endpoint, frozenset(params.items()))
+
+        return await self.inflight.do(key, lambda: self.__request(endpoint, params))
+
+    async def __request(self, endpoint: str, params: dict) -> dict:
+        token = await self.auth_manager.get_access_token_async()
+        headers = {"Authorization": f"Bearer {token}"}
+
+        for attempt in range(self.max_retries + 1):
+            if not self.api_circuit.allow():
+                raise SpotifyUnavailable(self.api_circuit.name)
+
+            await self.scheduler.acquire(self.auth_manager.user_id)
+
+            try:
+                async with self.session().get(self.API_PREFIX + endpoint, params=params, headers=headers, timeout=self.timeout(endpoint)) as response:
+                    spotify_responses_total.inc(endpoint=endpoint, status=response.status)
+
+                    # Let the scheduler pause everyone, then wait for our turn again
+                    if response.status == 429 and attempt < self.max_retries:
+                        self.scheduler.retry_after(float(response.headers.get("Retry-After", 1)))
+                        spotify_retries_total.inc(endpoint=endpoint)
+                        continue
+
+                    data = await self.__read_json(response)
+
+            except SpotifyException as e:
+                # A client error still means Spotify answered, rate limits are the scheduler's business
+                if e.http_status >= 500:
+                    self.api_circuit.record_failure()
+                elif e.http_status != 429:
+                    self.api_circuit.record_success()
+                raise
+
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                self.api_circuit.record_failure()
+                raise
+
+            self.api_circuit.record_success()
+            return data
+
+    @staticmethod
+    async def __read_json(response: aiohttp.ClientResponse) -> dict:
+        if response.status >= 400:
+            try:
+                error = (await response.json(content_type=None))["error"]
+                msg = error.get("message", "error")
+                reason = error.get("reason")
+            except Exception:
+                msg = await response.text() or "error"
+                reason = None
+
+            raise SpotifyException(
+                response.status,
+                -1,
+                f"{response.url}:\n {msg}",
+                reason=reason,
+                headers=response.headers
+            )
+
+        return await response.json(loads=loads, content_type=None)
+
+    async def get_bytes(self, url: str) -> bytes:
+        """Download a public resource (e.g. an image) through the shared session"""
+
+        return await self.inflight.do(("bytes", url), lambda: self.__download(url), timeout=10)
+
+    async def __download(self, url: str) -> bytes:
+        if not self.image_circuit.allow():
+            raise SpotifyUnavailable(self.image_circuit.name)
+
+        try:
+            content = await hedged(lambda: self.__download_once(url), self.image_hedge_delay, name="image")
+        except Exception as e:
+            if is_transient(e):
+                self.image_circuit.record_failure()
+            raise
+
+        self.image_circuit.record_success()
+        return content
+
+    async def __download_once(self, url: str) -> bytes:
+        async with self.session().get(url, timeout=aiohttp.ClientTimeout(total=self.image_timeout)) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    async def me(self) -> dict:
+        return await self._get("me/")
+
+    async def current_user_top_artists(self, limit=20, offset=0, time_range="medium_term") -> dict:
+        return await self._get("me/top/artists", limit=limit, offset=offset, time_range=time_range)
+
+    async def current_user_top_tracks(self, limit=20, offset=0, time_range="medium_term") -> dict:
+        return await self._get("me/top/tracks", limit=limit, offset=offset, time_range=time_range)
+
+    async def current_user_recently_played(self, limit=50, after=None, before=None) -> dict:
+        return await self._get("me/player/recently-played", limit=limit, after=after, before=before)
+
+metrics.gauge("fytops_scheduler_queue_depth", "Spotify requests waiting in the request scheduler", SpotifyClient.scheduler.queue_depth)
+metrics.gauge("fytops_scheduler_queued_users", "Discord users with Spotify requests waiting in the request scheduler", lambda: SpotifyClient.scheduler.stats()["queued_users"])
+metrics.gauge("fytops_scheduler_paused_seconds", "Seconds left before Spotify requests resume after a 429", lambda: round(SpotifyClient.scheduler.stats()["paused_for"], 3))
+metrics.gauge("fytops_scheduler_wait_avg_seconds", "Average seconds a Spotify request waited in the request scheduler", lambda: round(SpotifyClient.scheduler.stats()["avg_wait"], 4))
+metrics.gauge("fytops_scheduler_wait_max_seconds", "Longest seconds a Spotify request waited in the request scheduler", lambda: round(SpotifyClient.scheduler.max_wait, 4))
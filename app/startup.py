@@ -0,0 +1,36 @@
+import time
+
+from app.metrics import metrics
+
+startup_phase_seconds = metrics.histogram(
+    "fytops_startup_phase_seconds",
+    "Time spent in each startup phase, from process start to ready",
+    ("phase",),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+)
+
+class StartupTimer():
+    """Time the phases of a start, from the first import to the bot being ready"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = [] # (phase, seconds) in order
+        self._last = self.started
+
+    def mark(self, phase: str):
+        """End ``phase``, which started at the previous mark"""
+
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        startup_phase_seconds.observe(now - self._last, phase=phase)
+        self._last = now
+
+    @property
+    def elapsed(self) -> float:
+        return self._last - self.started
+
+    def summary(self) -> str:
+        phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases)
+        return f"Ready in {self.elapsed:.2f}s ({phases})"
+
+startup = StartupTimer()
@@ -0,0 +1,211 @@
+import time
+import heapq
+import random
+import asyncio
+import aiohttp
+from typing import Callable, Optional
+
+from app.spotifyapp import SpotifyApp, SpotifyAppOAuth
+from app.spotifyclient import SpotifyException, SpotifyOauthError, is_revoked
+from app.tokenstore import TokenStore, token_store
+from app.loggerFyTops import logger
+
+class TokenRefresher():
+    """Background scheduler refreshing access tokens shortly before they expire
+
+    Expiry times are kept in a min-heap, so commands always find a fresh token
+    in the token store and never wait on a refresh themselves
+    """
+
+    def __init__(self,
+                 create_auth_manager: Callable[[int], SpotifyAppOAuth],
+                 store: TokenStore = token_store,
+                 lead_time: float = 300,
+                 jitter: float = 60,
+                 retry_delay: float = 30,
+                 concurrency: int = 8,
+                 adopt_interval: float = 60):
+        """
+        Create a token refresh scheduler
+
+        Attributes
+        ---
+        create_auth_manager: :class:`Callable`
+            builds the :class:`SpotifyAppOAuth` of a Discord user id
+        store: :class:`TokenStore`
+            store holding every linked user's token
+        lead_time: :class:`float`
+            seconds before expiry a token gets refreshed
+        jitter: :class:`float`
+            maximum random number of seconds a refresh is moved earlier, spreading refreshes out
+        retry_delay: :class:`float`
+            seconds to wait before retrying after a network error
+        concurrency: :class:`int`
+            maximum number of refreshes in flight
+        adopt_interval: :class:`float`
+            seconds between two scans for tokens stored by other worker processes
+        """
+
+        self.create_auth_manager = create_auth_manager
+        self.store = store
+        self.lead_time = lead_time
+        self.jitter = jitter
+        self.retry_delay = retry_delay
+        self.concurrency = concurrency
+        self.adopt_interval = adopt_interval
+
+        self._heap = []
+        self._scheduled = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._task: Optional[asyncio.Task] = None
+        self._refreshes = set() # in-flight refresh tasks, referenced until done
+
+    def start(self):
+        """Schedule every stored token and start refreshing in the running event loop"""
+
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        for user_id in self.store.user_ids():
+            self.schedule(user_id)
+
+        self._task = asyncio.create_task(self.__run(), name="TokenRefresher")
+        logger.info("Token refresher started with %d scheduled users", len(self._scheduled))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        for task in list(self._refreshes):
+            task.cancel()
+        await asyncio.gather(*self._refreshes, return_exceptions=True)
+
+    def schedule(self, user_id: int, delay: float = None):
+        """
+        (Re)schedule the refresh of a user's token
+
+        Attributes
+        ---
+        user_id: :class:`int`
+            Discord id of the user
+        delay: :class:`float`
+            refresh after this many seconds instead of shortly before expiry
+        """
+
+        token_info = self.store.get(user_id)
+        if token_info is None:
+            self.unschedule(user_id)
+            return
+
+        now = time.time()
+        if delay is None:
+            refresh_at = token_info.get("expires_at", now) - self.lead_time - random.uniform(0, self.jitter)
+            refresh_at = max(refresh_at, now + random.uniform(0, self.jitter))
+        else:
+            refresh_at = now + delay
+
+        # Older heap entries of this user are skipped lazily when popped
+        self._scheduled[user_id] = refresh_at
+        heapq.heappush(self._heap, (refresh_at, user_id))
+
+        if self._wakeup is not None and self._heap[0][1] == user_id:
+            self._wakeup.set()
+
+    def unschedule(self, user_id: int):
+        self._scheduled.pop(user_id, None)
+
+    def adopt(self):
+        """Schedule the tokens stored by other worker processes, e.g. logins handled by another shard"""
+
+        for user_id in self.store.user_ids():
+            if user_id not in self._scheduled:
+                self.schedule(user_id)
+
+    async def __run(self):
+        next_adopt = time.monotonic() + self.adopt_interval
+        
+        while True:
+            if time.monotonic() >= next_adopt:
+                self.adopt()
+                next_adopt = time.monotonic() + self.adopt_interval
+
+            delay = next_adopt - time.monotonic()
+            if self._heap:
+                refresh_at, user_id = self._heap[0]
+                delay = min(delay, refresh_at - time.time())
+
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            if not self._heap:
+                continue
+
+            heapq.heappop(self._heap)
+            if self._scheduled.get(user_id) != refresh_at:
+                continue # stale entry
+
+            del self._scheduled[user_id]
+            await self._semaphore.acquire()
+            task = asyncio.create_task(self.__refresh(user_id))
+            self._refreshes.add(task)
+            task.add_done_callback(self._refreshes.discard)
+
+    async def __refresh(self, user_id: int):
+        try:
+            token_info = self.store.get(user_id)
+            if token_info is None:
+                return
+
+            # Token was already refreshed elsewhere, e.g. lazily by a command
+            if token_info.get("expires_at", 0) - time.time() > self.lead_time + self.jitter:
+                self.schedule(user_id)
+                return
+
+            auth_manager = self.create_auth_manager(user_id)
+            try:
+                await auth_manager.refresh_access_token_async(token_info["refresh_token"])
+                logger.debug("%s: Access token refreshed in background", user_id)
+                self.schedule(user_id)
+
+            # Refresh token invalid - user revoked authentication
+            except SpotifyOauthError as e:
+                if not is_revoked(e):
+                    self.schedule(user_id, delay=self.retry_delay)
+                    logger.error("%s: Token refresh failed, retrying in %ss: %s", user_id, self.retry_delay, e)
+                    return
+
+                await self.evict(user_id)
+                logger.warning("%s: Evicted token during refresh, user revoked app permission", user_id)
+
+            except (SpotifyException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.schedule(user_id, delay=self.retry_delay)
+                logger.error("%s: Token refresh failed, retrying in %ss: %s", user_id, self.retry_delay, e)
+
+        # Never drop a user from the schedule on an unexpected error
+        except Exception as e:
+            logger.error("%s: Unexpected error during token refresh, retrying in %ss: %s", user_id, self.retry_delay, e)
+            try:
+                self.schedule(user_id, delay=self.retry_delay)
+            except Exception as e:
+                logger.error("%s: Unable to reschedule the token refresh: %s", user_id, e)
+
+        finally:
+            self._semaphore.release()
+
+    async def evict(self, user_id: int):
+        """Forget a user's token, profile and pending refresh"""
+
+        self.unschedule(user_id)
+        self.store.delete(user_id)
+        await SpotifyApp.invalidate_user(user_id)
@@ -0,0 +1,335 @@
+import os
+import json
+import glob
+import time
+import sqlite3
+import threading
+from typing import Iterator, Optional
+
+from app.loggerFyTops import logger
+
+_DELETED = object()
+
+class TokenStore():
+    """Spotify tokens of every linked Discord user in a single SQLite file
+
+    Reads are served from an in-memory index, writes are queued and flushed
+    in batches by a background thread. The file may be shared by several worker
+    processes, the same thread picks up the changes committed by the others.
+    """
+
+    def __init__(self, path: str = "user_tokens.db", legacy_dir: str = "user_tokens", flush_interval: float = 1.0):
+        """
+        Create a token store, its file is opened (or created) on first use
+
+        Attributes
+        ---
+        path: :class:`str`
+            SQLite database file
+        legacy_dir: :class:`str`
+            directory of per-user ``.cache`` files imported by :meth:`migrate`
+        flush_interval: :class:`float`
+            maximum number of seconds a write waits before being flushed, and between
+            two checks for changes made by other processes
+        """
+
+        self.path = path
+        self.legacy_dir = legacy_dir
+        self.flush_interval = flush_interval
+
+        self._conn = None
+        self._index = None
+        self._open_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pending = {}
+        self._pending_refreshes = {} # user id -> (refresh token on disk, refreshed token info)
+        self._guilds = set() # (guild id, user id) pairs seen by this process
+        self._pending_guilds = set()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._writer = None
+
+    def __open(self):
+        """Open the database, load the index and start the writer thread, once"""
+
+        with self._open_lock:
+            if self._index is not None:
+                return
+
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tokens ("
+                "user_id INTEGER PRIMARY KEY, "
+                "token_info TEXT NOT NULL)"
+            )
+            
+            # Change tracking, so other processes only reload what changed
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(tokens)")]
+            if "updated_at" not in columns:
+                conn.execute("ALTER TABLE tokens ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS tokens_updated_at ON tokens (updated_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS deleted_tokens ("
+                "user_id INTEGER PRIMARY KEY, "
+                "deleted_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS guild_users ("
+                "guild_id INTEGER NOT NULL, "
+                "user_id INTEGER NOT NULL, "
+                "PRIMARY KEY (guild_id, user_id)) WITHOUT ROWID"
+            )
+            self._synced_at = time.time()
+            self._conn = conn
+
+            self._index = {
+                user_id: json.loads(token_info)
+                for user_id, token_info in conn.execute("SELECT user_id, token_info FROM tokens")
+            }
+
+            self._closed = False
+            self._writer = threading.Thread(target=self.__write_loop, name="TokenStoreWriter", daemon=True)
+            self._writer.start()
+
+    def __loaded(self) -> dict:
+        """Return the in-memory index, opening the store on first use"""
+
+        if self._index is None:
+            self.__open()
+        return self._index
+
+    def get(self, user_id: int) -> Optional[dict]:
+        return self.__loaded().get(user_id)
+
+    def set(self, user_id: int, token_info: dict):
+        index = self.__loaded()
+        with self._lock:
+            index[user_id] = token_info
+            self._pending[user_id] = token_info
+            self._pending_refreshes.pop(user_id, None)
+
+    def replace(self, user_id: int, refresh_token: str, token_info: dict) -> bool:
+        """
+        Store a refreshed token, only if the user is still linked with the refresh token it was obtained from
+
+        A logout or a new login while the refresh was in flight wins, in this process
+        and, when the change is flushed, in every other one
+
+        Returns
+        ---
+        :class:`bool`
+            whether the token was stored
+        """
+
+        index = self.__loaded()
+        with self._lock:
+            current = index.get(user_id)
+            if current is None or current.get("refresh_token") != refresh_token:
+                return False
+
+            index[user_id] = token_info
+            if user_id in self._pending:
+                self._pending[user_id] = token_info # not on disk yet, stored as is
+            else:
+                expected = self._pending_refreshes.get(user_id, (refresh_token,))[0]
+                self._pending_refreshes[user_id] = (expected, token_info)
+        return True
+
+    def delete(self, user_id: int):
+        index = self.__loaded()
+        with self._lock:
+            self._pending_refreshes.pop(user_id, None)
+            if index.pop(user_id, None) is not None:
+                self._pending[user_id] = _DELETED
+
+    def remember_guild(self, user_id: int, guild_id: int):
+        """Record that a user ran a command in a guild, queued like the token writes"""
+
+        pair = (guild_id, user_id)
+        if pair in self._guilds:
+            return
+
+        self.__loaded()
+        with self._lock:
+            self._guilds.add(pair)
+            self._pending_guilds.add(pair)
+
+    def guild_user_ids(self, guild_id: int) -> list:
+        """Return the linked users who ran a command in a guild, from every process (blocking)"""
+
+        index = self.__loaded()
+        self.flush()
+        with self._write_lock:
+            rows = self._conn.execute("SELECT user_id FROM guild_users WHERE guild_id = ?", (guild_id,)).fetchall()
+        return [user_id for (user_id,) in rows if user_id in index]
+
+    def user_ids(self) -> Iterator[int]:
+        return iter(list(self.__loaded()))
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.__loaded()
+
+    def __len__(self) -> int:
+        return len(self.__loaded())
+
+    def migrate(self):
+        """One-shot import of the legacy ``user_tokens/<user_id>.cache`` files
+
+        Run once before the workers start, a concurrent run is tolerated
+        """
+
+        legacy_dir = self.legacy_dir
+        if not os.path.isdir(legacy_dir):
+            return
+
+        index = self.__loaded()
+        migrated = 0
+        for path in glob.glob(os.path.join(legacy_dir, "*.cache")):
+            try:
+                user_id = int(os.path.splitext(os.path.basename(path))[0])
+                with open(path) as f:
+                    token_info = json.load(f)
+            except (ValueError, OSError) as e:
+                logger.warning("Skipped token file %s during migration: %s", path, e)
+                continue
+
+            with self._lock:
+                if user_id not in index:
+                    index[user_id] = token_info
+                    self._pending[user_id] = token_info
+                    migrated += 1
+
+        self.flush()
+        try:
+            os.rename(legacy_dir, f"{legacy_dir}.migrated")
+        except FileNotFoundError:
+            return # migrated by another process meanwhile, the upserts above were idempotent
+        logger.info("Migrated %d token files from %s/ into %s", migrated, legacy_dir, self.path)
+
+    def flush(self):
+        """Write every queued change to disk in a single transaction"""
+
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                refreshes, self._pending_refreshes = self._pending_refreshes, {}
+                guilds, self._pending_guilds = self._pending_guilds, set()
+
+            if not pending and not refreshes and not guilds:
+                return
+
+            now = time.time()
+            upserts = [(user_id, json.dumps(token_info), now) for user_id, token_info in pending.items() if token_info is not _DELETED]
+            deletes = [(user_id, now) for user_id, token_info in pending.items() if token_info is _DELETED]
+            lost = []
+
+            try:
+                with self._conn:
+                    self._conn.execute("BEGIN")
+                    self._conn.executemany(
+                        "INSERT INTO tokens (user_id, token_info, updated_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET token_info = excluded.token_info, updated_at = excluded.updated_at",
+                        upserts
+                    )
+                    self._conn.executemany("DELETE FROM deleted_tokens WHERE user_id = ?", [(user_id,) for user_id, _, _ in upserts])
+                    self._conn.executemany("DELETE FROM tokens WHERE user_id = ?", [(user_id,) for user_id, _ in deletes])
+                    self._conn.executemany(
+                        "INSERT INTO deleted_tokens (user_id, deleted_at) VALUES (?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET deleted_at = excluded.deleted_at",
+                        deletes
+                    )
+                    self._conn.executemany("INSERT OR IGNORE INTO guild_users (guild_id, user_id) VALUES (?, ?)", guilds)
+
+                    # Refreshes never bring back a token deleted or replaced by another process
+                    for user_id, (refresh_token, token_info) in refreshes.items():
+                        updated = self._conn.execute(
+                            "UPDATE tokens SET token_info = ?, updated_at = ? "
+                            "WHERE user_id = ? AND json_extract(token_info, '$.refresh_token') = ?",
+                            (json.dumps(token_info), now, user_id, refresh_token)
+                        ).rowcount
+                        if not updated:
+                            lost.append((user_id, token_info))
+            
+            # Requeue the batch unless a newer change arrived meanwhile
+            except sqlite3.Error:
+                with self._lock:
+                    for user_id, token_info in pending.items():
+                        self._pending.setdefault(user_id, token_info)
+                    for user_id, refresh in refreshes.items():
+                        if user_id not in self._pending:
+                            self._pending_refreshes.setdefault(user_id, refresh)
+                    self._pending_guilds |= guilds
+                raise
+
+            # The next sync loads what replaced them, unless this process changed the token since
+            with self._lock:
+                for user_id, token_info in lost:
+                    if self._index.get(user_id) is token_info:
+                        self._index.pop(user_id)
+
+    def sync(self):
+        """Load the tokens written or deleted by other processes since the last sync"""
+
+        with self._write_lock:
+            # Overlap the previous window a little, commits are not instantaneous
+            since = self._synced_at - 5
+            self._synced_at = time.time()
+
+            changed = self._conn.execute("SELECT user_id, token_info FROM tokens WHERE updated_at > ?", (since,)).fetchall()
+            deleted = self._conn.execute("SELECT user_id FROM deleted_tokens WHERE deleted_at > ?", (since,)).fetchall()
+
+        if not changed and not deleted:
+            return
+
+        changed = [(user_id, json.loads(token_info)) for user_id, token_info in changed]
+        with self._lock:
+            # Local changes not flushed yet are newer
+            for user_id, token_info in changed:
+                if user_id not in self._pending:
+                    self._index[user_id] = token_info
+            for (user_id,) in deleted:
+                if user_id not in self._pending:
+                    self._index.pop(user_id, None)
+
+    def close(self):
+        with self._open_lock:
+            if self._writer is None:
+                return
+
+            self._closed = True
+            self._wakeup.set()
+            self._writer.join()
+            self.flush()
+            self._conn.close()
+            self._conn, self._index, self._writer = None, None, None
+            self._wakeup.clear()
+
+    def __write_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+                self.sync()
+            except sqlite3.Error as e:
+                logger.error("Unable to flush token store: %s", e)
+
+class TokenCacheHandler():
+    """Cache handler (spotipy's interface) reading and writing one user's token in a :class:`TokenStore`"""
+
+    def __init__(self, user_id: int, store: TokenStore):
+        self.user_id = user_id
+        self.store = store
+
+    def get_cached_token(self):
+        return self.store.get(self.user_id)
+
+    def save_token_to_cache(self, token_info):
+        self.store.set(self.user_id, token_info)
+
+    def replace_cached_token(self, refresh_token: str, token_info: dict) -> bool:
+        return self.store.replace(self.user_id, refresh_token, token_info)
+
+token_store = TokenStore()
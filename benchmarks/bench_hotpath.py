@@ -0,0 +1,168 @@
+"""Offline micro-benchmarks for the command hot path
+
+Every stage runs against the recorded Spotify responses and sample avatars in
+``benchmarks/fixtures``, no network access or Discord connection is needed.
+
+Usage
+---
+    python benchmarks/bench_hotpath.py [--iterations N] [--stage PREFIX] [--output FILE] [--compare FILE]
+
+Results are written as JSON (per stage: timing percentiles in microseconds,
+peak and retained bytes allocated by one call). ``--compare`` prints the
+relative change against a previous result file.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "benchmarks", "fixtures")
+sys.path.insert(0, ROOT)
+
+def read_fixture(name: str, mode: str = "r"):
+    with open(os.path.join(FIXTURES, name), mode) as f:
+        return f.read()
+
+def measure(fn, iterations: int, warmup: int = 3) -> dict:
+    """Time ``fn`` over ``iterations`` calls, then trace the allocations of one more call"""
+
+    for _ in range(warmup):
+        fn()
+
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        fn()
+        samples.append((time.perf_counter_ns() - start) / 1000)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    fn()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    samples.sort()
+    return {
+        "iterations": iterations,
+        "mean_us": statistics.fmean(samples),
+        "median_us": statistics.median(samples),
+        "p95_us": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "min_us": samples[0],
+        "peak_alloc_bytes": peak - base,
+        "retained_bytes": current - base
+    }
+
+def build_stages() -> dict:
+    """Return the benchmarked callables keyed by stage name"""
+
+    # Imported here, after moving to a scratch directory, because the app
+    # modules open their stores relative to the working directory
+    from app.formatters import loads, LazyFields
+    from app.colorengine import extract_dominant_color
+    from app.spotifyapp import SpotifyApp
+    from app.discordapp import DiscordApp
+    from app.history import play_history
+    from discord import Color
+
+    raw = {name: read_fixture(f"{name}.json", "rb") for name in ("me", "top_artists", "top_tracks", "recently_played")}
+    data = {name: loads(content) for name, content in raw.items()}
+    avatars = {size: read_fixture(f"avatar_{size}.jpg", "rb") for size in (300, 640)}
+
+    play_history.append(0, data["recently_played"]["items"])
+    plays = play_history.recent(0, limit=50)
+
+    user_info = {
+        "description": "[fytops-bench](https://open.spotify.com/user/bench) on Spotify\nData generated on <t:1748779200:f>\n​",
+        "thumbnail": data["me"]["images"][0]["url"],
+        "color": Color.from_rgb(30, 215, 96)
+    }
+
+    def formatted(kind: str) -> dict:
+        items, format = {
+            "artists": (data["top_artists"]["items"], SpotifyApp.artist_field),
+            "tracks": (data["top_tracks"]["items"], SpotifyApp.track_field),
+            "recent": (plays, SpotifyApp.play_field)
+        }[kind]
+        return {**user_info, "title": f"Your **{kind}**", "fields": LazyFields(items, format)}
+
+    loop = asyncio.new_event_loop()
+
+    def paginate(pages: list, app: DiscordApp = None):
+        app = app or DiscordApp(formatted("tracks"))
+        app.per_page = 10
+        if not app.pages:
+            app.pages = [None] * 5
+        for page in pages:
+            loop.run_until_complete(app.render_page(page))
+        return app
+
+    warm = paginate(range(1, 6))
+
+    return {
+        "decode.top_artists": lambda: loads(raw["top_artists"]),
+        "decode.top_tracks": lambda: loads(raw["top_tracks"]),
+        "color.avatar_300": lambda: extract_dominant_color(avatars[300]),
+        "color.avatar_640": lambda: extract_dominant_color(avatars[640]),
+        "format.top_artists": lambda: list(formatted("artists")["fields"]),
+        "format.top_tracks": lambda: list(formatted("tracks")["fields"]),
+        "format.recent": lambda: list(formatted("recent")["fields"]),
+        "embed.build": lambda: paginate([1]),
+        "page.switch_cold": lambda: paginate([2, 3, 4, 5]),
+        "page.switch_warm": lambda: paginate([2, 3, 4, 5], warm)
+    }
+
+def compare(results: dict, baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = json.load(f)["stages"]
+
+    print(f"{'stage':<22}{'baseline us':>14}{'current us':>14}{'change':>10}", file=sys.stderr)
+    for stage, result in results["stages"].items():
+        if stage not in baseline:
+            continue
+        before, after = baseline[stage]["median_us"], result["median_us"]
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"{stage:<22}{before:>14.1f}{after:>14.1f}{change:>+9.1f}%", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the FyTops command hot path")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--stage", default="", help="only run stages starting with this prefix")
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="fytops-bench-"))
+    stages = build_stages()
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": int(time.time()),
+        "stages": {
+            name: measure(fn, args.iterations)
+            for name, fn in stages.items()
+            if name.startswith(args.stage)
+        }
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
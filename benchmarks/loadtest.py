@@ -0,0 +1,334 @@
+"""Load and soak test for the FyTops slash command handlers
+
+Runs the real ``FyTops`` command callbacks against a local fake Spotify server
+(started in a child process, with configurable latency, 429s and errors) and
+fake ``discord.Interaction`` objects. Concurrent simulated users are ramped up
+step by step; each step reports throughput, completion, first response and
+first page latency percentiles, interactions that missed Discord's 3 second
+deadline or were shed by admission control, event loop lag and memory growth.
+
+Usage
+---
+    python benchmarks/loadtest.py [--users 10,50,100] [--duration 30] [--latency 0.15]
+                                  [--rate-limit 0.01] [--errors 0.005] [--no-cache] [--output FILE]
+
+Use a long ``--duration`` with a single ``--users`` value as a soak test.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import multiprocessing
+from types import SimpleNamespace
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "benchmarks", "fixtures")
+sys.path.insert(0, ROOT)
+
+INTERACTION_DEADLINE = 3.0
+
+def run_fake_spotify(port: int, latency: float, rate_limit: float, errors: float):
+    """Serve Spotify-shaped responses from the benchmark fixtures (child process)"""
+
+    from aiohttp import web
+
+    def fixture(name: str) -> bytes:
+        with open(os.path.join(FIXTURES, name), "rb") as f:
+            return f.read()
+
+    # Serve profile pictures locally too, the color engine downloads them
+    me = fixture("me.json").replace(b"https://i.scdn.co/image/", f"http://127.0.0.1:{port}/avatar/".encode())
+    bodies = {
+        "me": me,
+        "artists": fixture("top_artists.json"),
+        "tracks": fixture("top_tracks.json"),
+        "recent": fixture("recently_played.json")
+    }
+    avatar = fixture("avatar_300.jpg")
+    token = json.dumps({"access_token": "fake", "token_type": "Bearer", "expires_in": 3600, "scope": "user-top-read user-read-recently-played"})
+
+    def respond(body: bytes):
+        async def handler(request):
+            await asyncio.sleep(random.expovariate(1 / latency) if latency else 0)
+            roll = random.random()
+            if roll < rate_limit:
+                return web.json_response({"error": {"status": 429, "message": "API rate limit exceeded"}}, status=429, headers={"Retry-After": "1"})
+            if roll < rate_limit + errors:
+                return web.json_response({"error": {"status": 500, "message": "Server error"}}, status=500)
+            return web.Response(body=body, content_type="application/json")
+        return handler
+
+    async def image(request):
+        await asyncio.sleep(latency)
+        return web.Response(body=avatar, content_type="image/jpeg")
+
+    async def token_endpoint(request):
+        return web.Response(text=token, content_type="application/json")
+
+    app = web.Application()
+    app.router.add_get("/v1/me/", respond(bodies["me"]))
+    app.router.add_get("/v1/me/top/artists", respond(bodies["artists"]))
+    app.router.add_get("/v1/me/top/tracks", respond(bodies["tracks"]))
+    app.router.add_get("/v1/me/player/recently-played", respond(bodies["recent"]))
+    app.router.add_get("/avatar/{name}", image)
+    app.router.add_post("/api/token", token_endpoint)
+    web.run_app(app, host="127.0.0.1", port=port, print=None)
+
+class FakeResponse():
+    """Stand-in for :class:`discord.InteractionResponse` recording when the user first sees something"""
+
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def __respond(self):
+        if self._done:
+            raise RuntimeError("This interaction has already been responded to before")
+        self._done = True
+        self.interaction.responded_at = time.perf_counter()
+
+    async def send_message(self, content=None, **kwargs):
+        await self.__respond()
+        self.interaction.shed = kwargs.get("ephemeral", False) # only the "busy" replies are ephemeral
+        self.interaction.show(kwargs.get("embed"))
+
+    async def defer(self, **kwargs):
+        await self.__respond()
+
+    async def edit_message(self, **kwargs):
+        self.interaction.show(kwargs.get("embed"))
+
+class FakeMessage():
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+
+    async def edit(self, **kwargs):
+        self.interaction.show(kwargs.get("embed"))
+
+class FakeFollowup():
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        self.interaction.show(kwargs.get("embed"))
+        return FakeMessage(self.interaction)
+
+class FakeInteraction():
+    """Minimal stand-in for :class:`discord.Interaction`"""
+
+    def __init__(self, user_id: int):
+        self.user = SimpleNamespace(
+            id=user_id,
+            name=f"load-{user_id}",
+            display_avatar=SimpleNamespace(url=f"https://cdn.discordapp.com/embed/avatars/{user_id % 5}.png")
+        )
+        self.guild = SimpleNamespace(id=1)
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.messages = []
+        self.created_at = datetime.now(timezone.utc) # read by admission control
+        self.started_at = time.perf_counter()
+        self.responded_at = None
+        self.first_page_at = None
+        self.shed = False
+
+    def show(self, embed):
+        if embed is not None and self.first_page_at is None:
+            self.first_page_at = time.perf_counter()
+        self.messages.append(embed)
+
+    async def original_response(self) -> FakeMessage:
+        return FakeMessage(self)
+
+    async def edit_original_response(self, **kwargs):
+        self.show(kwargs.get("embed"))
+        return FakeMessage(self)
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentile(samples: list, q: float) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+async def measure_loop_lag(samples: list, interval: float = 0.05):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - start - interval)
+
+def shed_commands() -> float:
+    from app.metrics import commands_total
+    return sum(commands_total.value(command=name, outcome="busy") for name in ("artists", "tracks", "recent"))
+
+async def run_step(commands: dict, users: int, duration: float, first_user: int) -> dict:
+    """Run ``users`` concurrent simulated users issuing commands back to back for ``duration`` seconds"""
+
+    latencies, first_responses, first_pages, failures, late = [], [], [], [], 0
+    lag = []
+    lag_task = asyncio.create_task(measure_loop_lag(lag))
+    rss_before = rss_bytes()
+    shed_before = shed_commands()
+    started = time.perf_counter()
+    deadline = started + duration
+
+    async def simulated_user(user_id: int):
+        nonlocal late
+        while time.perf_counter() < deadline:
+            name = random.choice(["artists", "tracks", "recent"])
+            interaction = FakeInteraction(user_id)
+            try:
+                if name == "recent":
+                    await commands[name].callback(interaction)
+                else:
+                    await commands[name].callback(interaction, time_range=random.choice(["short", "medium", "long"]))
+            except Exception as e:
+                failures.append(type(e).__name__)
+                continue
+
+            finished = time.perf_counter()
+            if interaction.responded_at is not None:
+                first_response = interaction.responded_at - interaction.started_at
+                first_responses.append(first_response)
+                late += first_response > INTERACTION_DEADLINE
+
+            # Told to try again later, like a user would
+            if interaction.shed:
+                await asyncio.sleep(1)
+                continue
+
+            latencies.append(finished - interaction.started_at)
+            if interaction.first_page_at is not None:
+                first_pages.append(interaction.first_page_at - interaction.started_at)
+
+    await asyncio.gather(*(simulated_user(first_user + i) for i in range(users)))
+    elapsed = time.perf_counter() - started # commands started before the deadline still finish
+    lag_task.cancel()
+
+    return {
+        "users": users,
+        "completed": len(latencies),
+        "failed": len(failures),
+        "failures": {name: failures.count(name) for name in set(failures)},
+        "missed_deadline": late,
+        "shed": int(shed_commands() - shed_before),
+        "elapsed_s": elapsed,
+        "throughput_per_s": len(latencies) / elapsed,
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "first_response_p50_ms": percentile(first_responses, 0.50) * 1000,
+        "first_response_p99_ms": percentile(first_responses, 0.99) * 1000,
+        "first_page_p50_ms": percentile(first_pages, 0.50) * 1000,
+        "first_page_p99_ms": percentile(first_pages, 0.99) * 1000,
+        "loop_lag_p99_ms": percentile(lag, 0.99) * 1000,
+        "loop_lag_max_ms": max(lag, default=0.0) * 1000,
+        "rss_growth_bytes": rss_bytes() - rss_before
+    }
+
+async def main(args):
+    from app.fytops import FyTops
+    from app.spotifyapp import SpotifyApp, SpotifyAppOAuth
+    from app.spotifyclient import SpotifyClient
+    from app.tokenstore import token_store
+    from app.loggerFyTops import logger
+    from app.admission import admission
+
+    if args.max_concurrent:
+        admission.max_concurrent = args.max_concurrent
+
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+
+    base = f"http://127.0.0.1:{args.port}"
+    SpotifyClient.API_PREFIX = f"{base}/v1/"
+    SpotifyAppOAuth.OAUTH_TOKEN_URL = f"{base}/api/token"
+
+    if args.no_cache:
+        SpotifyApp.profile_cache.ttl = 0
+        SpotifyApp.response_cache.ttls = {kind: (0, 0) for kind in SpotifyApp.response_cache.ttls}
+
+    # Link every simulated user up front
+    steps = [int(users) for users in args.users.split(",")]
+    total_users = sum(steps)
+    for user_id in range(1, total_users + 1):
+        token_store.set(user_id, {
+            "access_token": "fake",
+            "refresh_token": "fake",
+            "expires_at": int(time.time()) + 24 * 3600,
+            "scope": "user-top-read user-read-recently-played"
+        })
+
+    bot = FyTops("client-id", "client-secret", "http://127.0.0.1/callback")
+    commands = {name: bot.tree.get_command(name) for name in ("artists", "tracks", "recent")}
+
+    results = {"config": vars(args), "steps": []}
+    first_user = 1
+    for users in steps:
+        step = await run_step(commands, users, args.duration, first_user)
+        first_user += users
+        results["steps"].append(step)
+        print(
+            f"{users:>5} users  {step['throughput_per_s']:8.1f} cmd/s  "
+            f"p50 {step['latency_p50_ms']:8.1f} ms  p99 {step['latency_p99_ms']:8.1f} ms  "
+            f"first page p99 {step['first_page_p99_ms']:8.1f} ms  "
+            f"late {step['missed_deadline']:>4}  shed {step['shed']:>4}  failed {step['failed']:>4}  "
+            f"lag p99 {step['loop_lag_p99_ms']:6.1f} ms  rss +{step['rss_growth_bytes'] / 2**20:.1f} MiB",
+            file=sys.stderr
+        )
+
+    await SpotifyClient.close_session()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the FyTops command handlers")
+    parser.add_argument("--users", default="10,50,100,200", help="comma separated concurrent users per ramp step")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per ramp step")
+    parser.add_argument("--latency", type=float, default=0.15, help="mean fake Spotify latency in seconds")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="fraction of Spotify calls answered with 429")
+    parser.add_argument("--errors", type=float, default=0.0, help="fraction of Spotify calls answered with 500")
+    parser.add_argument("--no-cache", action="store_true", help="disable the profile and response caches")
+    parser.add_argument("--max-concurrent", type=int, help="override the admission control limit of commands running at once")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's per-command INFO logs")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(
+        target=run_fake_spotify,
+        args=(args.port, args.latency, args.rate_limit, args.errors),
+        daemon=True
+    )
+    server.start()
+    time.sleep(1.0) # let the fake server bind its port
+
+    # The app modules open their stores relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="fytops-load-"))
+
+    try:
+        results = asyncio.run(main(args))
+    finally:
+        server.terminate()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
@@ -6,4 +6,15 @@ load_dotenv()
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 REDIRECT_URI = os.getenv("REDIRECT_URI")
-BOT_TOKEN = os.getenv("BOT_TOKEN")
\ No newline at end of file
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+
+# OAuth callback server, REDIRECT_URI must point to its /callback route
+CALLBACK_HOST = os.getenv("CALLBACK_HOST", "0.0.0.0")
+CALLBACK_PORT = int(os.getenv("CALLBACK_PORT", 5000))
+
+# Sharding, WORKERS > 1 spreads the shards across several processes
+WORKERS = int(os.getenv("WORKERS", 1))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+
+# Register commands to this guild only while developing
+DEV_GUILD_ID = int(os.getenv("DEV_GUILD_ID")) if os.getenv("DEV_GUILD_ID") else None
\ No newline at end of file
@@ -1,11 +1,40 @@
-from config import CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, BOT_TOKEN
-from app.fytops import FyTops
-from app.backend import app
+import argparse
+
+# Imported first, its clock measures the whole start
+from app.startup import startup
+from config import CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, BOT_TOKEN, CALLBACK_HOST, CALLBACK_PORT, WORKERS, SHARD_COUNT, DEV_GUILD_ID
 
 def main():
-    fytops = FyTops(CLIENT_ID, CLIENT_SECRET, REDIRECT_URI)
+    parser = argparse.ArgumentParser(description="Run the FyTops Discord bot")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="number of worker processes, each running a range of shards")
+    parser.add_argument("--shards", type=int, default=SHARD_COUNT, help="total number of shards, Discord's recommendation by default")
+    args = parser.parse_args()
+    
+    # App modules are only imported where they run, the launcher migrates the stores itself
+    if args.workers > 1:
+        from app.launcher import Launcher
+        
+        settings = {
+            "bot_token": BOT_TOKEN,
+            "client_id": CLIENT_ID,
+            "client_secret": CLIENT_SECRET,
+            "redirect_uri": REDIRECT_URI,
+            "callback_host": CALLBACK_HOST,
+            "callback_port": CALLBACK_PORT,
+            "dev_guild_id": DEV_GUILD_ID
+        }
+        Launcher(settings, workers=args.workers, shard_count=args.shards).run()
+        return
+    
+    from app.fytops import FyTops
+    from app.launcher import migrate_stores
+    startup.mark("imports")
+    
+    migrate_stores()
+    
+    # The OAuth callback server runs in the bot's event loop, started by its setup hook
+    fytops = FyTops(CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, CALLBACK_HOST, CALLBACK_PORT, shard_count=args.shards, dev_guild_id=DEV_GUILD_ID)
     fytops.run(BOT_TOKEN)
-    app.run(debug=True)
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()